@@ -1,26 +1,55 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pony.orm import db_session
-from database import User
-from utils import check_active_subscription, decrypt_telegram_id
-import logging
+from aiogram import Bot
+from yookassa.domain.common import SecurityHelper
+from yookassa.domain.notification import WebhookNotificationFactory, WebhookNotificationEventType
+from tokens import parse_token, account_epoch
+from logger import setup_logger
+from payments import get_payment
+from subscriptions import activate_subscription
+from outline import close_clients
+from servers import registry
+from health import prober
+from keypool import key_pool
+from cache import TTLCache
+from invalidation import UserChangeListener
+from pg import get_pool, close_pool
+from database import count_pending_payments
+from metrics import CONF_LATENCY, PENDING_PAYMENTS, SERVER_DEVICES, SERVER_CAPACITY, monitor_loop_lag, read_snapshots, render
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
-# Создаём отдельный логгер для FastAPI
-logger = logging.getLogger("fastapi_server")
-logger.setLevel(logging.INFO)
-# Создаём обработчик для записи в файл
-file_handler = logging.FileHandler("api.log", encoding="utf-8")
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-# Добавляем обработчик в логгер
-logger.addHandler(file_handler)
-# Отключаем дублирование в root logger
-logger.propagate = False
-
-app = FastAPI()
+# Отдельный логгер для FastAPI: только файл, запись в фоновом потоке
+logger = setup_logger("fastapi_server", "api.log", console=False)
+
+# Бот нужен только для отправки сообщений после оплаты
+bot = Bot(token=os.getenv("TOKEN"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    probe_task = asyncio.create_task(prober.run())  # Проверка серверов Outline перед выдачей ключей
+    lag_task = asyncio.create_task(monitor_loop_lag())
+    user_changes.start()
+    yield
+    user_changes.stop()
+    await close_pool()
+    probe_task.cancel()
+    lag_task.cancel()
+    await key_pool.stop()  # Дожидаемся переименования выданных ключей
+    await registry.flush()  # Дописываем отложенные изменения hosts.json
+    await close_clients()  # Закрываем пулы соединений к Outline
+    await bot.session.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Настраиваем CORS
 app.add_middleware(
@@ -31,36 +60,183 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
+@app.middleware("http")
+async def measure_conf_latency(request: Request, call_next):
+    """Время ответа /conf по статусу ответа."""
+    if not request.url.path.startswith("/conf/"):
+        return await call_next(request)
+    started = time.perf_counter()
+    response = await call_next(request)
+    CONF_LATENCY.observe(time.perf_counter() - started, status=response.status_code)
+    return response
+
+
+# Токен для /metrics (Authorization: Bearer ...); без него эндпоинт выключен
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Метрики API и бота в формате Prometheus (хосты Outline и нагрузка серверов - только по токену)."""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404)
+    if not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Неверный токен", headers={"WWW-Authenticate": "Bearer"})
+
+    PENDING_PAYMENTS.set(await asyncio.to_thread(count_pending_payments))
+    SERVER_DEVICES.clear()
+    SERVER_CAPACITY.clear()
+    for server in await registry.get_servers():
+        SERVER_DEVICES.set(server.get("current_devices", 0), server=server["host"])
+        SERVER_CAPACITY.set(server.get("max_devices", 0), server=server["host"])
+
+    snapshots = await asyncio.to_thread(read_snapshots)
+    return Response(content=render("api", snapshots), media_type="text/plain; version=0.0.4")
+
+
 PREFIX = "%13%03%03%3F"  # Префикс для маскировки
 
+# Готовые ответы /conf по telegram_id; сбрасываются по уведомлению об изменении пользователя
+conf_cache = TTLCache(
+    maxsize=int(os.getenv("CONF_CACHE_SIZE", "50000")),
+    ttl=int(os.getenv("CONF_CACHE_TTL", "300")),
+)
+user_changes = UserChangeListener(conf_cache.invalidate)
+
+# Ровно те колонки, что нужны для ответа и проверки доступа
+CONF_QUERY = (
+    'SELECT host, server_port, password, method, subscription_end, trial_end_date, created_at '
+    'FROM "user" WHERE telegram_id = $1'
+)
+
+# Сколько секунд помним отказ: клиенты без подписки переподключаются постоянно
+CONF_DENY_TTL = int(os.getenv("CONF_DENY_TTL", "60"))
+
 @app.get("/conf/{encrypted_id}")
-@db_session
-def get_connection_data(encrypted_id: str):
+async def get_connection_data(encrypted_id: str, request: Request):
     """Обрабатывает GET-запрос для получения данных подключения."""
     try:
-        telegram_id = decrypt_telegram_id(encrypted_id)
+        # Подпись проверяется без БД; старые ключи без подписи тоже принимаются
+        telegram_id, epoch = parse_token(encrypted_id)
     except ValueError:
         logger.error(f"Ошибка декодирования encrypted_id: {encrypted_id}")
         raise HTTPException(status_code=400, detail="Некорректный encrypted_id")
 
-    user = User.get(telegram_id=telegram_id)
+    cached = conf_cache.get(telegram_id)
+    if cached is None:
+        cached = await load_connection_data(telegram_id)
+
+    status, body, etag, account = cached
+    if status == 404:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    if epoch is not None and epoch != account:
+        # Токен выдан удаленной и заново созданной учетной записи
+        raise HTTPException(status_code=403, detail="Ключ отозван")
+    if status == 403:
+        raise HTTPException(status_code=403, detail="Подписка не активна или пробный ключ истек")
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+async def load_connection_data(telegram_id: int):
+    """Читает пользователя одним запросом и кладет в кэш готовый ответ или отказ."""
+    # Уведомление об изменении, пришедшее во время запроса, не даст закэшировать старую строку
+    generation = conf_cache.generation
+    pool = await get_pool()
+    user = await pool.fetchrow(CONF_QUERY, telegram_id)
 
     if not user:
         logger.error(f"Пользователь с telegram_id={telegram_id} не найден")
-        raise HTTPException(status_code=404, detail="Пользователь не найден")
+        cached = (404, None, None, None)
+        conf_cache.set(telegram_id, cached, CONF_DENY_TTL, generation)
+        return cached
 
-    # Проверяем подписку
-    if not check_active_subscription(telegram_id) and not user.started:
-        logger.warning(f"Пользователь {telegram_id} пытается подключиться без активной подписки")
-        raise HTTPException(status_code=403, detail="Подписка не активна или пробный ключ истек")
+    account = account_epoch(user["created_at"])
+
+    # Проверяем подписку или пробный период: срок проверяется здесь, а не в токене,
+    # поэтому ключ не меняется при продлении
+    now = datetime.now()
+    access_end = max(filter(None, (user["subscription_end"], user["trial_end_date"])), default=None)
+    has_access = access_end is not None and access_end > now
+    # Отозванный ключ (host/server_port очищены) - тоже отказ, а не ошибка 500 на каждом опросе
+    revoked = user["host"] is None or user["server_port"] is None
+    if revoked or not has_access:
+        logger.warning(f"Пользователь {telegram_id} пытается подключиться без активной подписки или ключа")
+        # После оплаты отказ сбросит уведомление об изменении пользователя
+        cached = (403, None, None, account)
+        conf_cache.set(telegram_id, cached, CONF_DENY_TTL, generation)
+        return cached
 
     # Формируем данные для подключения
     connection_data = {
-        "server": user.host,
-        "server_port": int(user.server_port),
-        "password": user.password,
-        "method": user.method,
+        "server": user["host"],
+        "server_port": int(user["server_port"]),
+        "password": user["password"],
+        "method": user["method"],
         "prefix": PREFIX
     }
+    body = json.dumps(connection_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    cached = (200, body, f'"{hashlib.sha256(body).hexdigest()[:32]}"', account)
+    # Запись не должна пережить окончание доступа: дальше ответит кэшированный отказ
+    conf_cache.set(telegram_id, cached, min(conf_cache.ttl, (access_end - now).total_seconds()), generation)
+    return cached
+
+
+# Проверять, что уведомление пришло с IP-адресов ЮKassa
+YOOKASSA_CHECK_IP = os.getenv("YOOKASSA_CHECK_IP", "1") == "1"
+
+PAYMENT_EVENTS = (
+    WebhookNotificationEventType.PAYMENT_SUCCEEDED,
+    WebhookNotificationEventType.PAYMENT_CANCELED,
+)
+
+@app.post("/yookassa/webhook")
+async def yookassa_webhook(request: Request, background_tasks: BackgroundTasks):
+    """Принимает уведомления ЮKassa о платежах."""
+    # За nginx реальный адрес клиента приходит в X-Real-IP
+    client_ip = request.headers.get("X-Real-IP") or request.client.host
+    if YOOKASSA_CHECK_IP and not SecurityHelper().is_ip_trusted(client_ip):
+        logger.warning(f"Уведомление ЮKassa с недоверенного IP {client_ip}")
+        raise HTTPException(status_code=403, detail="Недоверенный источник")
+
+    try:
+        notification = WebhookNotificationFactory().create(await request.json())
+    except Exception as e:
+        logger.error(f"Некорректное уведомление ЮKassa: {e}")
+        raise HTTPException(status_code=400, detail="Некорректное уведомление")
+
+    if notification.event not in PAYMENT_EVENTS:
+        return JSONResponse(content={}, status_code=200)
+
+    # Отвечаем сразу, обработка идет в фоне: ЮKassa повторяет уведомление при медленном ответе
+    background_tasks.add_task(process_payment_notification, notification.object.id, notification.event)
+    return JSONResponse(content={}, status_code=200)
+
+
+async def process_payment_notification(payment_id: str, event: str):
+    """Сверяет платеж с API ЮKassa и активирует подписку."""
+    # Телу уведомления не доверяем: берем актуальный платеж из API
+    payment = await get_payment(payment_id)
+    if not payment:
+        logger.error(f"Платеж {payment_id} из уведомления не найден в ЮKassa")
+        return
+
+    if payment.status == "canceled":
+        logger.info(f"Платеж {payment_id} отменен")
+        return
+
+    if payment.status != "succeeded":
+        logger.warning(f"Статус платежа {payment_id} ({payment.status}) не совпадает с событием {event}")
+        return
+
+    try:
+        user_id = int(payment.metadata["user_id"])
+        days = int(payment.metadata["days"])
+        amount = float(payment.amount.value)
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"В платеже {payment_id} нет данных подписки: {e}")
+        return
 
-    return JSONResponse(content=connection_data, status_code=200)
+    if await activate_subscription(bot, user_id, payment_id, days, amount):
+        logger.info(f"Подписка пользователя {user_id} активирована по уведомлению ЮKassa")
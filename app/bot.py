@@ -3,24 +3,38 @@ import os
 import signal
 from logger import logger
 import locale
-from payments import create_payment, get_payment_status
+from payments import create_payment
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F, Router
+from aiogram import Bot, Dispatcher, F, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, CallbackQuery, Message
 from aiogram.types.input_file import FSInputFile
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from pony.orm import db_session, commit, count
-from database import User, Subscription, Payment, get_all_data, get_user_data, clear_user_data
-from keygen import generate_vpn_key, delete_vpn_key, activate_trial
+from pony.orm import db_session, commit
+from database import User, Subscription, notify_users_changed, get_user_data, clear_user_data, get_expired_trials, get_expired_subscriptions, get_expiring_subscriptions, get_server_usage, get_notification_targets, mark_notified
+from keygen import delete_vpn_key, activate_trial
+from subscriptions import add_pending_payment, reconcile_pending_payments
+from outline import close_clients
+from pg import close_pool
+from health import prober, PROBE_INTERVAL
+from keypool import key_pool, REFILL_INTERVAL
+from revocation import revoke_keys
+from notifier import NotificationQueue
+from media import media_cache
+from metrics import HandlerTimingMiddleware, monitor_loop_lag, run_snapshots, snapshot_path
+from fsm_storage import create_storage
+from profiles import get_profile, invalidate_profile, profile_cache
+from invalidation import UserChangeListener
+from throttling import ThrottlingMiddleware
+from reports import parse_filter, build_report, report_filename, USAGE_TEXT
+from broadcast import create_broadcast, start_broadcast, resume_broadcasts
 from info import welcome_text, info_about_vpn, instruction
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from servers import load_servers_from_file, has_free_slots, update_current_devices_in_hosts
-from collections import defaultdict
+from servers import registry, update_current_devices_in_hosts
 
 scheduler = AsyncIOScheduler()
 
@@ -29,12 +43,32 @@ locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 
+# polling - один процесс; webhook - BOT_WORKERS процессов за nginx
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # Публичный адрес, например https://e-airvpn.ru
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "2"))
+# Несколько процессов должны видеть одно состояние FSM, поэтому в режиме вебхука хранилище общее
+FSM_STORAGE = os.getenv("FSM_STORAGE") or ("pony" if BOT_MODE == "webhook" else "memory")
+
 # Making bot
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
+dp = Dispatcher(storage=create_storage(FSM_STORAGE))
+notifications = NotificationQueue(bot)
+# Изменения пользователей из API (оплата по вебхуку) и других воркеров сбрасывают кэш профилей
+user_changes = UserChangeListener(profile_cache.invalidate)
 # Router
 router = Router()
 dp.include_router(router)
+router.message.middleware(HandlerTimingMiddleware())
+router.callback_query.middleware(HandlerTimingMiddleware())
+# Один экземпляр на оба типа апдейтов: ведра и текущие запросы общие
+throttling = ThrottlingMiddleware()
+router.message.middleware(throttling)
+router.callback_query.middleware(throttling)
 
 # Start menu
 @router.message(Command("menu"))
@@ -72,11 +106,10 @@ async def reply_keyboard():
         ],
         resize_keyboard=True  # Делает клавиатуру адаптивной по размеру
     )
-@router.message(F.text == "Пробный ключ")
-@db_session
+@router.message(F.text == "Пробный ключ", flags={"throttling": {"rate": 1 / 10}})
 async def process_trial_key(message: Message):
     user_id = message.from_user.id
-    user = User.get(telegram_id=user_id)
+    user = await get_profile(user_id)
     
     # Если пользователя нет в базе данных
     if not user:
@@ -127,7 +160,10 @@ async def welcome_message(message: Message):
         inviter = User.get(referral_code=ref_code)
         if inviter:
             user.referred_by = str(inviter.telegram_id)  # Сохраняем пригласившего
+            notify_users_changed([inviter.telegram_id])  # Другие воркеры сбросят его профиль
     commit()
+    if ref_code and inviter:
+        invalidate_profile(inviter.telegram_id)  # Изменилось число приглашенных
     main_menu = await main_menu_keyboard()
     # Welcome text + buttons
     reply_kb = await reply_keyboard()
@@ -149,7 +185,7 @@ async def show_payment_menu(callback: CallbackQuery):
     pay_menu = await payment_menu()
     await callback.message.edit_text("💰 Выберите тарифный план:", reply_markup=pay_menu)
 
-@router.callback_query(F.data.in_(["1_month", "3_months", "6_months"]))
+@router.callback_query(F.data.in_(["1_month", "3_months", "6_months"]), flags={"throttling": {"rate": 1 / 5}})
 async def handle_subscription(callback: CallbackQuery):
     """Обрабатывает нажатие на кнопку подписки и передаёт управление в `process_subscription`."""
     await callback.answer()
@@ -179,8 +215,7 @@ async def process_subscription(callback: CallbackQuery):
             return
 
     # Проверяем наличие мест на сервере
-    servers = await load_servers_from_file('hosts.json')
-    if not await has_free_slots(servers):
+    if not await registry.has_free_slots():
         await callback.message.answer("❌ Нет свободных мест на серверах. Напишите в поддержку.")
         return
 
@@ -197,13 +232,13 @@ async def process_subscription(callback: CallbackQuery):
     ])
     payment_message = await callback.message.edit_text("Пожалуйста, перейдите по ссылке для оплаты:", reply_markup=markup)
 
-    # Проверяем статус оплаты
-    await check_payment_status(user_id, payment_id, days, amount, payment_message.message_id)
+    # Платеж подтвердит вебхук ЮKassa, а если он не дойдет - фоновая сверка
+    await asyncio.to_thread(add_pending_payment, user_id, payment_id, amount, days, payment_message.message_id)
     
 async def generate_payment_link(user_id: int, amount: int, days: int):
     """Создаёт платёжную ссылку и возвращает URL и ID платежа."""
     try:
-        payment_url, payment_id = await create_payment(amount, f"Подписка на {days} дней", user_id)
+        payment_url, payment_id = await create_payment(amount, f"Подписка на {days} дней", user_id, days)
         if payment_url and payment_id:
             logger.info(f"✅ Платёжная ссылка создана: {payment_url}")
             return payment_url, payment_id
@@ -214,191 +249,80 @@ async def generate_payment_link(user_id: int, amount: int, days: int):
         logger.error(f"🚨 Ошибка при создании платежа: {e}")
         return None, None
 
-async def check_payment_status(user_id, payment_id, days, amount, payment_message, timeout=600, check_interval=10):
-    start_time = datetime.now()
-    while True:
-        try:
-            status = await get_payment_status(payment_id)
-            if status == "succeeded":
-                with db_session:
-                    user = User.get(telegram_id=user_id)
-                    if user:
-                        logger.info("Заносим данные в БД...")
-                        await bot.delete_message(user_id, payment_message)
-                        # Получаем текущую активную подписку
-                        active_subscription = Subscription.get(user=user, status="Active")
-
-                        # Если подписка активна, продлеваем её
-                        if active_subscription and active_subscription.end_date > datetime.now():
-                            logger.info("Подписка активна, продлеваем её...")
-                            active_subscription.end_date += timedelta(days=days)
-                            user.subscription_end = active_subscription.end_date
-                            is_new_subscription = False
-                        elif active_subscription and active_subscription.end_date <= datetime.now():
-                            logger.info("Продлеваем завершенную подписку")
-                            active_subscription.end_date += timedelta(days=days)
-                            user.subscription_end = active_subscription.end_date
-                            is_new_subscription = False
-                        else:
-                            # Если подписки нет или она закончилась, создаём новую
-                            logger.info("Создаю новую подписку")
-                            now = datetime.now()
-                            user.subscription_end = now + timedelta(days=days)  # Корректная дата окончания
-                            logger.info(f"Дата окончания подписки: {user.subscription_end}")
-                            active_subscription = Subscription(
-                                user=user,
-                                start_date=now,
-                                end_date=user.subscription_end,
-                                amount=amount,
-                                status="Active",
-                            )
-                            is_new_subscription = True
-
-                        # Записываем платеж
-                        payment = Payment(
-                            id=payment_id,
-                            user=user,
-                            amount=amount,
-                            payment_date=datetime.now(),
-                            status=status
-                        )
-
-                        if payment.id:
-                            user.last_payment_id = str(payment.id)
-                            logger.info("Платеж был занесен в БД")
-                            
-                        commit()
-
-                        formatted_date = user.subscription_end.strftime("%d %B %Y")
-
-                        # Генерация нового ключа, если это новая подписка или ключ был удалён
-                        if is_new_subscription:
-                            logger.info("Генерируем новый VPN-ключ...")
-                            if user.trial_end_date and user.trial_end_date > datetime.now():
-                                    user.trial_end_date = datetime.now()
-                                    logger.info(f"Удаляем пробный ключ {user.key_id}")
-                                    await delete_vpn_key(user.key_id)
-                                    
-                            result = await generate_vpn_key(user_id)
-
-                            if result:
-                                user.trial_used = True
-                                logger.info("Сгенерировал новый ключ")
-                                dynamic_key = result
-                                # Отправляем сообщение с ключом в формате кода
-                                await bot.send_message(user_id, "✅ Оплата подтверждена! Тапните, чтобы скопировать Ваш VPN-ключ:")
-                                await bot.send_message(user_id, text=f"`{dynamic_key}`", parse_mode="MarkdownV2")
-                            else:
-                                logger.error("Ошибка: generate_vpn_key() вернул None!")
-                                await bot.send_message(user_id, "⚠️ Ошибка генерации VPN-ключа. Напишите в поддержку @vpnstalker.")
-                        elif not user.access_key:
-                            logger.info("Генерирую ключ после продления закончившейся подписки")
-                            result = await generate_vpn_key(user_id)
-                            if result:
-                                dynamic_key = result
-                                await bot.send_message(user_id, "✅ Оплата подтверждена! Ваш VPN-ключ активен!")
-                        else:
-                            await bot.send_message(user_id, f"📅 Ваша подписка продлена! Теперь она активна до {formatted_date}\nПереходите в Outline и подключайтесь!")
-
-                        break
-            
-            elapsed_time = (datetime.now() - start_time).total_seconds()
-            if elapsed_time > timeout:
-                await bot.send_message(user_id, "⏳ Время на оплату истекло. Попробуйте снова.")
-
-            await asyncio.sleep(check_interval)
-            
-        except Exception as e:
-            logger.error(f"Ошибка при проверке статуса платежа {payment_id}: {e}")
-            await bot.send_message(user_id, "⚠️ Произошла ошибка при проверке платежа. Попробуйте позже.")
-            break
-
 async def check_subscriptions():
     try:
-        server_usage = defaultdict(int)  # Храним число активных пользователей на каждом сервере
-
-        with db_session:
-            for user in User.select():  # Используем генератор, не загружаем всех в память
-                logger.info(f"🔍 Проверяю подписку пользователя {user.telegram_id}...")
-
-                # 1️⃣ Проверяем пробную подписку
-                if user.trial_used and user.trial_end_date and not user.subscription_end:
-                    trial_hours_left = (user.trial_end_date - datetime.now()).total_seconds() / 3600  
-
-                    if trial_hours_left <= 0:
-                        logger.info("Пробная подписка использована и закончилась")
-
-                        if user.key_id:
-                            delete_key = await delete_vpn_key(user.key_id)
-
-                            with db_session:
-                                u = User.get(telegram_id=user.telegram_id)
-                                if u:
-                                    u.key_id = None  # Очищаем VPN-ключ
-                                    commit()
-
-                            if delete_key:
-                                logger.info(f"✅ Пробный ключ пользователя {user.telegram_id} был удален.")
-                                await bot.send_message(
-                                    user.telegram_id,
-                                    "⏳ Пробный ключ деактивирован.\nОформите подписку, чтобы продолжить пользоваться VPN."
-                                )
-                            else:
-                                logger.warning(f"⚠ Ошибка удаления пробного ключа пользователя {user.telegram_id}.")
-
-                # 2️⃣ Проверяем обычную подписку
-                if user.subscription_end and user.key_id:
-                    sub_hours_left = (user.subscription_end - datetime.now()).total_seconds() / 3600  
-
-                    if sub_hours_left <= 0:
-                        delete_key = await delete_vpn_key(user.key_id)
-
-                        with db_session:
-                            u = User.get(telegram_id=user.telegram_id)
-                            if u:
-                                u.key_id = None  # Очищаем VPN-ключ
-                                commit()
-
-                        if delete_key:
-                            logger.info(f"✅ Подписка пользователя {user.telegram_id} истекла, ключ удалён.")
-                            await bot.send_message(
-                                user.telegram_id,
-                                "❌ Срок вашей подписки истёк.\nПродлите её, чтобы снова пользоваться VPN."
-                            )
-                        else:
-                            logger.warning(f"⚠ Ошибка удаления ключа пользователя {user.telegram_id}.")
-
-                    elif 0 < sub_hours_left <= 72:
-                        await bot.send_message(
-                            user.telegram_id,
-                            f"⚠ Ваша подписка истекает через {int(sub_hours_left // 24)} дня "
-                            f"({user.subscription_end.strftime('%d %B %Y')}).\nОплатите заранее, и дни прибавятся к остатку!"
-                        )
-
-                # 3️⃣ Учитываем активные подключения
-                if user.host:
-                    server_usage[user.host] += 1
+        now = datetime.now()
+
+        # 1️⃣ Закончившиеся пробные ключи и 2️⃣ истекшие подписки
+        expired_trials = await asyncio.to_thread(get_expired_trials, now)
+        expired_subscriptions = await asyncio.to_thread(get_expired_subscriptions, now)
+        revoked = await revoke_keys(list(expired_trials) + list(expired_subscriptions))
+
+        for telegram_id, _, _ in expired_trials:
+            if telegram_id in revoked:
+                notifications.put(
+                    telegram_id,
+                    "⏳ Пробный ключ деактивирован.\nОформите подписку, чтобы продолжить пользоваться VPN."
+                )
+        for telegram_id, _, _ in expired_subscriptions:
+            if telegram_id in revoked:
+                notifications.put(
+                    telegram_id,
+                    "❌ Срок вашей подписки истёк.\nПродлите её, чтобы снова пользоваться VPN."
+                )
+
+        # 3️⃣ Подписки, истекающие в ближайшие 72 часа
+        expiring = await asyncio.to_thread(get_expiring_subscriptions, now, now + timedelta(hours=72))
+        for telegram_id, subscription_end in expiring:
+            sub_hours_left = (subscription_end - now).total_seconds() / 3600
+            notifications.put(
+                telegram_id,
+                f"⚠ Ваша подписка истекает через {int(sub_hours_left // 24)} дня "
+                f"({subscription_end.strftime('%d %B %Y')}).\nОплатите заранее, и дни прибавятся к остатку!"
+            )
 
         logger.info("✅ Проверка подписок завершена")
 
     except Exception as e:
         logger.error(f"🚨 Ошибка проверки подписок: {e}")
 
-    await update_current_devices_in_hosts(server_usage)  # Обновляем активные устройства
+async def reconcile_server_usage():
+    """Сверяет счетчики устройств в hosts.json с числом ключей в БД."""
+    try:
+        usage = await asyncio.to_thread(get_server_usage)
+        # Серверы без ключей в БД тоже должны получить актуальный ноль
+        server_usage = {server["host"]: usage.get(server["host"], 0) for server in await registry.get_servers()}
+        await update_current_devices_in_hosts(server_usage)
+    except Exception as e:
+        logger.error(f"🚨 Ошибка сверки устройств на серверах: {e}")
+
+NOTIFY_COOLDOWN = timedelta(days=int(os.getenv("NOTIFY_COOLDOWN_DAYS", "7")))  # Не чаще раза в столько дней на пользователя
+NOTIFY_PAGE_SIZE = 1000
 
 async def send_notification():
     try:
-        with db_session:
-            # Фильтрация на уровне базы данных
-            users = User.select(lambda u: not u.trial_used and not u.subscription_end)
-            
-            for user in users:
-                await bot.send_message(
-                    user.telegram_id, 
-                    "Еще не попробовали? Нажмите кнопку **Пробный ключ** и испытайте\nскорость нашего VPN за 24 часа!", 
+        now = datetime.now()
+        after_id = 0
+        notified = 0
+        # Только новые пользователи и те, у кого истек период тишины; страницы по telegram_id
+        while True:
+            page = await asyncio.to_thread(get_notification_targets, now - NOTIFY_COOLDOWN, after_id, NOTIFY_PAGE_SIZE)
+            if not page:
+                break
+
+            for telegram_id in page:
+                notifications.put(
+                    telegram_id,
+                    "Еще не попробовали? Нажмите кнопку **Пробный ключ** и испытайте\nскорость нашего VPN за 24 часа\\!",
                     parse_mode="MarkdownV2"
                 )
-                
+            await notifications.drain()  # Не держим в очереди больше одной страницы
+            await asyncio.to_thread(mark_notified, page, now)
+            notified += len(page)
+            after_id = page[-1]
+
+        logger.info(f"Напоминание о пробном ключе поставлено в очередь для {notified} пользователей")
+
     except Exception as e:
         logger.error(f"Произошла ошибка оповещений новых юзеров: {e}")
         
@@ -411,7 +335,11 @@ def get_next_20():
 # Scheduler
 def start_scheduler():
     scheduler.add_job(check_subscriptions, IntervalTrigger(hours=3), replace_existing=True)
-    scheduler.add_job(send_notification, IntervalTrigger(days=2, start_date=get_next_20()), id="send_notification_job", replace_existing=True)
+    scheduler.add_job(reconcile_server_usage, IntervalTrigger(hours=1), id="reconcile_usage_job", replace_existing=True)
+    scheduler.add_job(prober.probe_all, IntervalTrigger(seconds=PROBE_INTERVAL), id="health_probe_job", replace_existing=True, next_run_time=datetime.now())
+    scheduler.add_job(key_pool.refill, IntervalTrigger(seconds=REFILL_INTERVAL), kwargs={"reconcile": True}, id="key_pool_job", replace_existing=True, next_run_time=datetime.now())
+    scheduler.add_job(reconcile_pending_payments, IntervalTrigger(seconds=30), args=[bot], id="reconcile_payments_job", replace_existing=True)
+    scheduler.add_job(send_notification, IntervalTrigger(days=1, start_date=get_next_20()), id="send_notification_job", replace_existing=True)
     logger.info("✅ Планировщик задач запущен.")
 
 def stop_scheduler():
@@ -443,30 +371,29 @@ async def create_user_if_not_exists(telegram_id, username, ref_code=None):
     return user
 
 
-@router.message(F.text == "🔑 Мой ключ")
+@router.message(F.text == "🔑 Мой ключ", flags={"throttling": {"rate": 1 / 3}})
 async def show_my_keys(message: Message):
     user_id = message.from_user.id
-    with db_session:
-        user = User.get(telegram_id=user_id)
-        if user:
-            # Проверяем, что subscription_end и trial_end_date не равны None
-            if user.dynamic_key:
-                if user.subscription_end and user.subscription_end > datetime.now():
-                    key = user.dynamic_key
-                    # Отправляем ключ как код
-                    await message.answer("Тапните, чтобы скопировать")
-                    await message.answer(f"`{key}`", parse_mode="MarkdownV2")
-                elif user.trial_end_date and user.trial_end_date > datetime.now():
-                    key = user.dynamic_key
-                    # Отправляем ключ как код
-                    await message.answer("Тапните, чтобы скопировать")
-                    await message.answer(f"`{key}`", parse_mode="MarkdownV2")
-                else:
-                    await message.answer("У вас нет активных ключей или подписка истекла.")
+    user = await get_profile(user_id)
+    if user:
+        # Проверяем, что subscription_end и trial_end_date не равны None
+        if user.dynamic_key:
+            if user.subscription_end and user.subscription_end > datetime.now():
+                key = user.dynamic_key
+                # Отправляем ключ как код
+                await message.answer("Тапните, чтобы скопировать")
+                await message.answer(f"`{key}`", parse_mode="MarkdownV2")
+            elif user.trial_end_date and user.trial_end_date > datetime.now():
+                key = user.dynamic_key
+                # Отправляем ключ как код
+                await message.answer("Тапните, чтобы скопировать")
+                await message.answer(f"`{key}`", parse_mode="MarkdownV2")
             else:
-                await message.answer("У вас нет VPN-ключа. Для подключения оформите подписку или пробный ключ")
+                await message.answer("У вас нет активных ключей или подписка истекла.")
         else:
-            await message.answer("Пользователь не найден.")
+            await message.answer("У вас нет VPN-ключа. Для подключения оформите подписку или пробный ключ")
+    else:
+        await message.answer("Пользователь не найден.")
 
 @router.callback_query(F.data == "support")
 async def support_menu(callback: CallbackQuery):
@@ -495,7 +422,9 @@ async def process_successful_payment(user_id: int):
                     logger.warning("Не удалось найти активную подписку для инвайтера.")
 
                 inviter.referral_bonus_active = True
+                notify_users_changed([inviter.telegram_id])
                 commit()
+                invalidate_profile(inviter.telegram_id)
 
                 logger.info(f"Пользователь {inviter.telegram_id} получил 1 месяц бесплатно!")
                 await bot.send_message(inviter.telegram_id, "🎉 Вам начислен бонус: +1 месяц к вашей подписке!")
@@ -512,11 +441,10 @@ async def info(callback: CallbackQuery):
     await callback.message.edit_text(info_about_vpn, reply_markup=builder.as_markup())
 
 @router.callback_query(F.data == "referral")
-@db_session
 async def refferal_link(callback: CallbackQuery):
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main"))
-    user = User.get(telegram_id=callback.message.chat.id)
+    user = await get_profile(callback.message.chat.id)
     if user:
         ref_link = f"https://t.me/@vpn_airbot?start={user.referral_code}"
         await callback.message.edit_text(f"Ваша реферральная ссылка: {ref_link}\nПосле оплаты приглашенного вы получите +1 месяц бесплатно", reply_markup=builder.as_markup())
@@ -587,18 +515,19 @@ async def send_image(message: Message, index: int, state: FSMContext):
         image_path = GUIDE_IMAGES[index]
 
         if os.path.exists(image_path):
-            media_file = FSInputFile(image_path)
             keyboard = await generate_pagination_keyboard(index)
 
+            # Картинка загружается в Telegram один раз, дальше уходит по file_id
             if "message_id" in data:
-                await message.bot.edit_message_media(
-                    media=types.InputMediaPhoto(media=media_file),
+                await media_cache.edit_photo(
+                    message.bot,
                     chat_id=message.chat.id,
                     message_id=data["message_id"],
+                    path=image_path,
                     reply_markup=keyboard
                 )
             else:
-                sent_message = await message.answer_photo(media_file, reply_markup=keyboard)
+                sent_message = await media_cache.answer_photo(message, image_path, reply_markup=keyboard)
                 await state.update_data(message_id=sent_message.message_id)
         else:
             await message.answer(f"❌ Изображение не найдено: {image_path}")
@@ -639,29 +568,26 @@ async def close_screenshots(callback: CallbackQuery, state: FSMContext):
     await callback.answer("📌 Просмотр завершен!")
 
 
-@router.message(F.text == "📊 Статус подписки")
-@db_session
+@router.message(F.text == "📊 Статус подписки", flags={"throttling": {"rate": 1 / 3}})
 async def handle_status(message: Message):
-    user = User.get(telegram_id=message.chat.id)
+    # Профиль из кэша: дата первой подписки и число приглашенных уже посчитаны
+    user = await get_profile(message.chat.id)
 
     if not user:
         await message.answer("❌ Вы не зарегистрированы в системе.")
         return
 
-    # Дата начала подписки (берем первую подписку пользователя)
-    first_subscription = user.subscriptions.order_by(lambda s: s.start_date).first()
-
     # Дата окончания подписки
     subscription_end = user.subscription_end
 
     # Количество приглашенных пользователей
-    invited_count = count(u for u in User if u.referred_by == user)  # ✅ Теперь count импортирован
+    invited_count = user.invited_count
 
 
     if subscription_end and subscription_end > datetime.now():
         status = "🟩 Активна"
         sub_end_text = subscription_end.strftime("%d %B %Y")
-        sub_start_text = first_subscription.start_date.strftime("%d %B %Y") if first_subscription else "Неизвестно"
+        sub_start_text = user.first_subscription_start.strftime("%d %B %Y") if user.first_subscription_start else "Неизвестно"
         
         text = (
             f"📊 <b>Статус подписки</b>\n\n"
@@ -681,20 +607,33 @@ AUTHORIZED_USER_ID = int(os.getenv("AUTHORIZED_USER_ID"))
 @router.message(Command('database'))
 async def handle_get_data(message: Message):
     if message.chat.id == AUTHORIZED_USER_ID:
-        command_parts = message.text.split()
-        if len(command_parts) == 1:
-            data = await asyncio.to_thread(get_all_data) 
-            await message.answer(data)
-        elif len(command_parts) == 2:
-           
-            username = command_parts[1]
+        args = message.text.split()[1:]
+        try:
+            report_filter = parse_filter(args)
+        except ValueError:
+            await message.answer(USAGE_TEXT)
+            return
+
+        if report_filter is None:
+            if len(args) != 1:
+                await message.answer(USAGE_TEXT)
+                return
+            username = args[0]
             data = await asyncio.to_thread(get_user_data, username)
             if data:
                 await message.answer(data)
             else:
                 await message.answer(f"Пользователь с именем '{username}' не найден.")
-        else:
-            await message.answer("Некорректный формат команды. Используйте /database или /database <username>.")
+            return
+
+        path, written = await asyncio.to_thread(build_report, report_filter)
+        try:
+            await message.answer_document(
+                FSInputFile(path, filename=report_filename(report_filter)),
+                caption=f"📊 Пользователей в отчёте: {written}",
+            )
+        finally:
+            os.remove(path)
 
 
 @router.message(Command("get_key"))
@@ -742,7 +681,6 @@ async def restart(message: Message):
             await message.answer(f"Произошла ошибка {e}")
 
 @router.message(Command("send_all"))
-@db_session
 async def send_all(message: Message):
     if message.chat.id == AUTHORIZED_USER_ID:
         command_parts = message.text.split(maxsplit=1)
@@ -751,27 +689,88 @@ async def send_all(message: Message):
             return
 
         text = command_parts[1]
-        failed_users = 0
+        progress = await message.reply("📤 Рассылка запущена...")
+        broadcast_id = await asyncio.to_thread(create_broadcast, message.chat.id, text, progress.message_id)
+        start_broadcast(bot, broadcast_id)
 
-        for user in User.select():  # Используем генератор, чтобы не загружать всех сразу
-            try:
-                await bot.send_message(user.telegram_id, text)
-            except Exception as e:
-                failed_users += 1
-                logger.error(f"❌ Не удалось отправить сообщение пользователю {user.telegram_id}: {e}")
 
-        await message.reply(f"✅ Рассылка завершена. Ошибок: {failed_users}")
+background_tasks = []
 
+async def on_startup(worker=None):
+    """Запуск фоновых задач. Планировщик и рассылки работают только в одном процессе (worker 0)."""
+    primary = not worker
+    background_tasks.append(asyncio.create_task(monitor_loop_lag()))  # Метрика задержки event loop
+    background_tasks.append(asyncio.create_task(run_snapshots(snapshot_path(worker))))  # Метрики для /metrics API
+    notifications.start()  # Фоновая отправка уведомлений
+    user_changes.start()
+    if primary:
+        start_scheduler()  # Запуск планировщика
+        scheduler.start()
+        await resume_broadcasts(bot)  # Продолжаем прерванные рассылки
+        await media_cache.warm_up(bot, GUIDE_IMAGES)  # Загружаем картинки инструкции заранее
+
+async def on_shutdown(worker=None):
+    if not worker and scheduler.running:
+        stop_scheduler()  # Корректная остановка планировщика
+    for task in background_tasks:
+        task.cancel()
+    user_changes.stop()
+    await notifications.stop()
+    await key_pool.stop()  # Дожидаемся переименования выданных ключей
+    await registry.flush()  # Дописываем отложенные изменения hosts.json
+    await close_clients()  # Закрываем пулы соединений к Outline
+    await close_pool()
+    await dp.storage.close()
 
 async def main():
     try:
-        start_scheduler()  # Запуск планировщика
-        scheduler.start()
+        await on_startup()
         await dp.start_polling(bot)  # Запуск бота
     except KeyboardInterrupt:
         logger.info("Бот остановлен вручную.")
     finally:
-        stop_scheduler()  # Корректная остановка планировщика
+        await on_shutdown()
+
+def run_webhook_worker(worker):
+    """Один процесс вебхука. Все воркеры слушают один порт (SO_REUSEPORT), ядро делит между ними соединения."""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+    async def startup(app):
+        await on_startup(worker)
+        if worker == 0:
+            await bot.set_webhook(
+                f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"Вебхук установлен, воркеров: {BOT_WORKERS}")
+
+    async def shutdown(app):
+        await on_shutdown(worker)
+        await bot.session.close()
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=True, print=None)
+
+def run_webhook():
+    """Запускает BOT_WORKERS процессов; текущий процесс становится воркером 0."""
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_webhook_worker, args=(worker,)) for worker in range(1, BOT_WORKERS)]
+    for process in workers:
+        process.start()
+    try:
+        run_webhook_worker(0)
+    finally:
+        for process in workers:
+            process.terminate()
+            process.join()
+
 def signal_handler(sig, frame):
     print('Завершаю работу...')
     # Здесь не нужно использовать asyncio.get_event_loop().stop(), так как мы используем async обработку
@@ -781,6 +780,9 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 if __name__ == "__main__":
-    # Запуск главной асинхронной функции
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        # Запуск главной асинхронной функции
+        asyncio.run(main())
 
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from pony.orm import db_session, select, count
+from logger import logger
+from database import User, Broadcast
+from notifier import send_message
+
+PAGE_SIZE = 500  # Пользователей на страницу; после каждой страницы сохраняется курсор
+WORKERS = 20  # Одновременных отправок (общий темп всё равно ограничивает ведро токенов)
+PROGRESS_INTERVAL = 5  # Секунды между обновлениями сообщения с прогрессом
+
+_running = {}  # broadcast_id -> задача
+
+
+@db_session
+def create_broadcast(admin_chat_id, text, progress_message_id):
+    broadcast = Broadcast(
+        text=text,
+        admin_chat_id=admin_chat_id,
+        progress_message_id=progress_message_id,
+        total=count(u for u in User),
+    )
+    broadcast.flush()
+    return broadcast.id
+
+
+@db_session
+def _load(broadcast_id):
+    broadcast = Broadcast[broadcast_id]
+    return broadcast.to_dict()
+
+
+@db_session
+def _next_page(after_id):
+    return select(u.telegram_id for u in User if u.telegram_id > after_id).order_by(1)[:PAGE_SIZE]
+
+
+@db_session
+def _save_progress(broadcast_id, last_user_id, sent, failed, status=None):
+    broadcast = Broadcast[broadcast_id]
+    broadcast.last_user_id = last_user_id
+    broadcast.sent = sent
+    broadcast.failed = failed
+    if status:
+        broadcast.status = status
+
+
+def _progress_text(state, finished=False):
+    title = "✅ Рассылка завершена." if finished else "📤 Идёт рассылка..."
+    return (
+        f"{title}\n"
+        f"Отправлено: {state['sent']} из {state['total']}\n"
+        f"Ошибок: {state['failed']}"
+    )
+
+
+async def _report(bot, state, finished=False):
+    if not state["progress_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(
+            _progress_text(state, finished),
+            chat_id=state["admin_chat_id"],
+            message_id=state["progress_message_id"],
+        )
+    except Exception as e:
+        logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+
+
+async def run_broadcast(bot, broadcast_id):
+    """Рассылает сообщение всем пользователям, начиная с сохраненного курсора."""
+    try:
+        await _run(bot, broadcast_id)
+    except Exception as e:
+        # Статус остается running, рассылка продолжится после перезапуска
+        logger.error(f"🚨 Рассылка #{broadcast_id} прервана: {e}")
+
+
+async def _run(bot, broadcast_id):
+    state = _load(broadcast_id)
+    semaphore = asyncio.Semaphore(WORKERS)
+    last_report = time.monotonic()
+
+    async def deliver(chat_id):
+        async with semaphore:
+            return await send_message(bot, chat_id, state["text"])
+
+    logger.info(f"Рассылка #{broadcast_id}: старт с пользователя {state['last_user_id']}")
+    while True:
+        page = await asyncio.to_thread(_next_page, state["last_user_id"])
+        if not page:
+            break
+
+        results = await asyncio.gather(*(deliver(chat_id) for chat_id in page))
+        state["sent"] += sum(results)
+        state["failed"] += len(results) - sum(results)
+        state["last_user_id"] = page[-1]
+        await asyncio.to_thread(_save_progress, broadcast_id, state["last_user_id"], state["sent"], state["failed"])
+
+        if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await _report(bot, state)
+
+    await asyncio.to_thread(_save_progress, broadcast_id, state["last_user_id"], state["sent"], state["failed"], "done")
+    await _report(bot, state, finished=True)
+    logger.info(f"Рассылка #{broadcast_id} завершена: отправлено {state['sent']}, ошибок {state['failed']}")
+
+
+def start_broadcast(bot, broadcast_id):
+    """Запускает рассылку в фоне, если она ещё не идёт."""
+    task = _running.get(broadcast_id)
+    if task and not task.done():
+        return task
+    task = _running[broadcast_id] = asyncio.create_task(run_broadcast(bot, broadcast_id))
+    task.add_done_callback(lambda t: _running.pop(broadcast_id, None))
+    return task
+
+
+async def resume_broadcasts(bot):
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    with db_session:
+        unfinished = select(b.id for b in Broadcast if b.status == "running")[:]
+    for broadcast_id in unfinished:
+        logger.info(f"Продолжаю прерванную рассылку #{broadcast_id}")
+        start_broadcast(bot, broadcast_id)
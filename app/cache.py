@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU-кэш с временем жизни записей; безопасен для вызовов из нескольких потоков."""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # Счётчик инвалидаций
+        self._invalidated = OrderedDict()  # ключ -> номер последней инвалидации
+        self._invalidated_floor = 0  # Номер самой новой вытесненной из _invalidated записи
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    @property
+    def generation(self):
+        """Номер, который загрузка запоминает до чтения из БД и передаёт в set()."""
+        return self._generation
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Кладёт значение. С generation - только если ключ не инвалидировали после его получения:
+        иначе загрузка прочитала устаревшие данные. Возвращает, записано ли значение.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and self._invalidated.get(key, self._invalidated_floor) > generation:
+                return False
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else default
+
+    def invalidate(self, key):
+        """Удаляет запись и не даёт начатым раньше загрузкам этого ключа положить старое значение."""
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.maxsize:
+                _, self._invalidated_floor = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
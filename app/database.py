@@ -1,7 +1,10 @@
-from pony.orm import Database, Required, Optional, Set, PrimaryKey, db_session, select
+from pony.orm import Database, Required, Optional, Set, PrimaryKey, Json, composite_key, db_session, select, count, exists, flush
 from datetime import datetime
 import os
+import time
 from dotenv import load_dotenv
+from migrations import apply_migrations
+from metrics import DB_QUERY_LATENCY
 
 load_dotenv()
 
@@ -11,7 +14,18 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-db = Database()
+# Канал NOTIFY, в который сообщаем об изменении данных пользователя (для сброса кэшей)
+USER_CHANGED_CHANNEL = "user_changed"
+NOTIFY_CHUNK_SIZE = 500  # Полезная нагрузка NOTIFY ограничена 8000 байт
+
+class InstrumentedDatabase(Database):
+    """Database, который пишет время каждого SQL-запроса в метрики (из любого потока)"""
+
+    def _update_local_stat(self, sql, query_start_time):
+        super()._update_local_stat(sql, query_start_time)
+        DB_QUERY_LATENCY.observe(time.time() - query_start_time)
+
+db = InstrumentedDatabase()
 
 class User(db.Entity):
     telegram_id = PrimaryKey(int, size=64)  
@@ -32,9 +46,11 @@ class User(db.Entity):
     dynamic_key = Optional(str, nullable=True)
     key_id = Optional(int, nullable=True)
     last_payment_id = Optional(str, nullable=True)
+    last_notified_at = Optional(datetime)  # Когда последний раз отправляли рекламное напоминание
     created_at = Required(datetime, default=datetime.now)  
     subscriptions = Set('Subscription')
     payments = Set('Payment')  
+    pending_payments = Set('PendingPayment')
 
 class Subscription(db.Entity):
     user = Required(User, reverse='subscriptions')
@@ -50,6 +66,55 @@ class Payment(db.Entity):
     payment_date = Required(datetime, default=datetime.now)
     status = Required(str)
 
+class PendingPayment(db.Entity):
+    id = PrimaryKey(str)
+    user = Required(User, reverse='pending_payments')
+    amount = Required(float)
+    days = Required(int)
+    message_id = Optional(int, nullable=True)
+    status = Required(str, default="pending")
+    created_at = Required(datetime, default=datetime.now)
+
+class Broadcast(db.Entity):
+    text = Required(str)
+    admin_chat_id = Required(int, size=64)
+    progress_message_id = Optional(int, nullable=True)
+    status = Required(str, default="running")
+    last_user_id = Required(int, size=64, default=0)  # Курсор: все telegram_id до него уже обработаны
+    total = Required(int, default=0)
+    sent = Required(int, default=0)
+    failed = Required(int, default=0)
+    created_at = Required(datetime, default=datetime.now)
+
+class PooledKey(db.Entity):
+    """Заранее созданный на сервере Outline ключ, ещё не выданный пользователю"""
+    host = Required(str)
+    key_id = Required(int)
+    access_key = Required(str)
+    server_port = Required(str)
+    password = Required(str)
+    method = Required(str)
+    created_at = Required(datetime, default=datetime.now)
+
+class MigrationStep(db.Entity):
+    """Контрольная точка переноса пользователя между серверами (update_node.py)"""
+    source = Required(str)
+    target = Required(str)
+    telegram_id = Required(int, size=64)
+    old_key_id = Optional(int, nullable=True)
+    new_key_id = Optional(int, nullable=True)
+    status = Required(str)  # moved - пользователь на новом сервере, done - старый ключ удален, failed
+    error = Optional(str, nullable=True)
+    updated_at = Required(datetime, default=datetime.now)
+    composite_key(source, target, telegram_id)
+
+class FsmRecord(db.Entity):
+    """Состояние FSM aiogram: общее для всех процессов бота в режиме вебхука"""
+    key = PrimaryKey(str)
+    state = Optional(str, nullable=True)
+    data = Optional(Json)
+    updated_at = Required(datetime, default=datetime.now)
+
 
 db.bind(
     provider="postgres",
@@ -60,38 +125,201 @@ db.bind(
     port=DB_PORT
 )
 
-db.generate_mapping(create_tables=True)
+# create_tables не добавляет колонки и индексы в уже существующие таблицы:
+# они приходят из миграций, поэтому схему сверяем только после них
+db.generate_mapping(create_tables=True, check_tables=False)
+apply_migrations(db)
+db.check_tables()
+
+@db_session
+def notify_users_changed(telegram_ids):
+    """Сообщает другим процессам, что данные пользователей изменились (доставляется после commit).
+
+    flush() и db.execute открывают транзакцию, поэтому NOTIFY входит в ту же транзакцию,
+    что и изменения, даже если до этого сессия только читала (autocommit).
+    """
+    ids = [str(telegram_id) for telegram_id in telegram_ids]
+    flush()
+    for start in range(0, len(ids), NOTIFY_CHUNK_SIZE):
+        payload = ",".join(ids[start:start + NOTIFY_CHUNK_SIZE])
+        db.execute("SELECT pg_notify($channel, $payload)", {"channel": USER_CHANGED_CHANNEL, "payload": payload})
 
 @db_session
-def get_all_data():
-    users = select(u for u in User if u.subscriptions.exists(lambda s: s.status == "Active"))[:]
+def get_expired_trials(now):
+    """Пользователи без подписки, у которых закончился пробный период, а ключ ещё не удалён"""
+    return select(
+        (u.telegram_id, u.key_id, u.host) for u in User
+        if u.trial_used and u.trial_end_date <= now
+        and u.subscription_end is None and u.key_id is not None
+    )[:]
 
-    if not users:
-        return "Нет активных пользователей."
+@db_session
+def get_expired_subscriptions(now):
+    """Пользователи с истекшей подпиской и неудаленным ключом"""
+    return select(
+        (u.telegram_id, u.key_id, u.host) for u in User
+        if u.subscription_end <= now and u.key_id is not None
+    )[:]
 
-    response = "🔹 *Список активных пользователей:*\n\n"
+@db_session
+def get_expiring_subscriptions(now, until):
+    """Пользователи, у которых подписка закончится в промежутке (now, until]"""
+    return select(
+        (u.telegram_id, u.subscription_end) for u in User
+        if u.subscription_end > now and u.subscription_end <= until and u.key_id is not None
+    )[:]
 
-    for user in users:
-        response += f"👤 *{user.username}* (ID: {user.telegram_id})\n"
-        response += f"🔑 VPN-ключ: `{user.access_key or 'нет'}`\n"
-        response += f"📅 Подписка до: {user.subscription_end.strftime('%Y-%m-%d') if user.subscription_end else 'Нет'}\n"
-        response += f"🔑 ID ключа: `{user.key_id or 'нет'}`\n"
+@db_session
+def get_server_usage():
+    """Число выданных ключей на каждом сервере одним GROUP BY host"""
+    return dict(select(
+        (u.host, count(u)) for u in User
+        if u.host is not None and u.key_id is not None
+    )[:])
 
-        subscriptions = [s for s in user.subscriptions if s.status == "Active"]
-        for sub in subscriptions:
-            response += f"  ├ 🏷 {sub.amount}₽ | {sub.start_date.strftime('%d.%m.%Y')} → {sub.end_date.strftime('%d.%m.%Y')}\n"
+@db_session
+def add_pooled_key(host, data):
+    """Сохраняет в пул ключ из ответа Outline POST /access-keys"""
+    PooledKey(
+        host=host,
+        key_id=int(data["id"]),
+        access_key=data["accessUrl"],
+        server_port=str(data["port"]),
+        password=data["password"],
+        method=data["method"],
+    )
 
-        payments = user.payments.order_by(Payment.payment_date)
-        if payments:
-            response += "  💳 *Платежи:*\n"
-            for payment in payments:
-                response += f"  ├ 💰 {payment.amount}₽ | {payment.payment_date.strftime('%d.%m.%Y')} | {payment.status}\n"
+@db_session
+def claim_pooled_key(host):
+    """Забирает из пула ключ сервера; строки, занятые параллельными выдачами, пропускаются"""
+    key = PooledKey.select(lambda k: k.host == host).order_by(PooledKey.id).for_update(skip_locked=True).first()
+    if key is None:
+        return None
+    data = {
+        "access_key": key.access_key,
+        "key_id": key.key_id,
+        "server_port": key.server_port,
+        "method": key.method,
+        "password": key.password,
+    }
+    key.delete()
+    return data
 
-        response += "\n"
-    if len(response) > 1024:
-        return "Ответ слишком длинный, попробуй /database user"
-    else:
-        return response.strip()
+@db_session
+def get_unassigned_keys(host, key_ids):
+    """Ключи сервера из key_ids, которых нет ни в пуле, ни у пользователей"""
+    key_ids = tuple(key_ids)
+    pooled = select(k.key_id for k in PooledKey if k.host == host and k.key_id in key_ids)[:]
+    assigned = select(u.key_id for u in User if u.host == host and u.key_id in key_ids)[:]
+    return set(key_ids) - set(pooled) - set(assigned)
+
+@db_session
+def get_pool_sizes():
+    """Число свободных ключей в пуле по серверам"""
+    return dict(select((k.host, count(k)) for k in PooledKey)[:])
+
+@db_session
+def get_fsm_record(key):
+    """(state, data) для ключа FSM"""
+    record = FsmRecord.get(key=key)
+    if record is None:
+        return None, {}
+    return record.state, dict(record.data or {})
+
+@db_session
+def save_fsm_record(key, **fields):
+    """Сохраняет state и/или data; пустая запись удаляется"""
+    record = FsmRecord.get(key=key)
+    if record is None:
+        record = FsmRecord(key=key, data={})
+    record.set(updated_at=datetime.now(), **fields)
+    if record.state is None and not record.data:
+        record.delete()
+
+@db_session
+def count_pending_payments():
+    """Число платежей, ожидающих подтверждения"""
+    return count(p for p in PendingPayment if p.status == "pending")
+
+@db_session
+def get_notification_targets(notified_before, after_id, limit):
+    """Пользователи без пробного ключа и подписки, которых не уведомляли с notified_before (страница по telegram_id)"""
+    return select(
+        u.telegram_id for u in User
+        if not u.trial_used and u.subscription_end is None
+        and (u.last_notified_at is None or u.last_notified_at <= notified_before)
+        and u.telegram_id > after_id
+    ).order_by(1)[:limit]
+
+@db_session
+def mark_notified(telegram_ids, notified_at):
+    """Запоминает время уведомления одним UPDATE"""
+    ids = list(telegram_ids)
+    db.execute(
+        'UPDATE "user" SET last_notified_at = $notified_at WHERE telegram_id = ANY($ids)',
+        {"ids": ids, "notified_at": notified_at}
+    )
+
+@db_session
+def clear_user_keys(telegram_ids):
+    """Удаляет данные VPN-ключа у пользователей одним UPDATE, подписку не трогает"""
+    ids = list(telegram_ids)
+    db.execute(
+        'UPDATE "user" SET access_key = NULL, key_id = NULL, host = NULL, '
+        'server_port = NULL, password = NULL, method = NULL '
+        'WHERE telegram_id = ANY($ids)',
+        {"ids": ids}
+    )
+    notify_users_changed(ids)
+
+def _report_users(status, host, expiring_until):
+    query = select(u for u in User)
+    if status == "active":
+        query = query.filter(lambda u: exists(s for s in u.subscriptions if s.status == "Active"))
+    elif status == "expiring":
+        now = datetime.now()
+        query = query.filter(lambda u: u.subscription_end > now and u.subscription_end <= expiring_until)
+    if host:
+        query = query.filter(lambda u: u.host == host)
+    return query
+
+@db_session
+def get_report_cursor(status, host, expiring_until, offset):
+    """telegram_id, после которого идут пользователи отчёта со сдвигом offset.
+
+    Читает только id, без подписок и платежей. None - пользователей меньше, чем offset.
+    """
+    if offset <= 0:
+        return 0
+    ids = select(u.telegram_id for u in _report_users(status, host, expiring_until)).order_by(1)[offset - 1:offset]
+    return ids[0] if ids else None
+
+@db_session
+def get_report_page(status, host, expiring_until, after_id, limit):
+    """Страница пользователей для отчёта /database (по telegram_id) с подписками и платежами.
+
+    Подписки и платежи всей страницы загружаются двумя запросами, а не по запросу на пользователя.
+    """
+    users = _report_users(status, host, expiring_until).filter(lambda u: u.telegram_id > after_id)
+    users = users.order_by(User.telegram_id)[:limit]
+
+    ids = [u.telegram_id for u in users]
+    subscriptions = {telegram_id: [] for telegram_id in ids}
+    payments = {telegram_id: [] for telegram_id in ids}
+    if ids:
+        for sub in select(s for s in Subscription if s.user.telegram_id in ids).order_by(Subscription.start_date):
+            subscriptions[sub.user.telegram_id].append((sub.amount, sub.start_date, sub.end_date, sub.status))
+        for payment in select(p for p in Payment if p.user.telegram_id in ids).order_by(Payment.payment_date):
+            payments[payment.user.telegram_id].append((payment.amount, payment.payment_date, payment.status))
+
+    return [
+        (
+            (u.telegram_id, u.username, u.host, u.key_id, u.access_key, u.subscription_end, u.trial_end_date),
+            subscriptions[u.telegram_id],
+            payments[u.telegram_id],
+        )
+        for u in users
+    ]
 
 @db_session
 def get_user_data(username):
@@ -126,7 +354,9 @@ def clear_user_data(telegram_id=802171486):
     if user:
         Subscription.select(lambda s: s.user == user).delete(bulk=True)
         Payment.select(lambda p: p.user == user).delete(bulk=True)
+        PendingPayment.select(lambda p: p.user == user).delete(bulk=True)
         user.delete()
+        notify_users_changed([telegram_id])
         print(f"✅ Данные пользователя {telegram_id} полностью удалены.")
         return f"✅ Данные пользователя {telegram_id} полностью удалены."
     else:
@@ -0,0 +1,52 @@
+import asyncio
+import os
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from dotenv import load_dotenv
+from database import get_fsm_record, save_fsm_record
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+
+class PonyStorage(BaseStorage):
+    """Хранилище FSM в Postgres, чтобы состояние видели все процессы бота.
+
+    Запросы выполняются в пуле потоков и не блокируют обработку других апдейтов.
+    """
+
+    def __init__(self, key_builder=None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(save_fsm_record, self.key_builder.build(key), state=state)
+
+    async def get_state(self, key):
+        state, _ = await asyncio.to_thread(get_fsm_record, self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        await asyncio.to_thread(save_fsm_record, self.key_builder.build(key), data=dict(data))
+
+    async def get_data(self, key):
+        _, data = await asyncio.to_thread(get_fsm_record, self.key_builder.build(key))
+        return data
+
+    async def close(self):
+        pass
+
+
+def create_storage(backend):
+    """Хранилище FSM по имени: memory (один процесс), pony или redis."""
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "pony":
+        return PonyStorage()
+    if backend == "redis":
+        # Пакет redis нужен только для этого варианта
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL)
+    raise ValueError(f"Неизвестное хранилище FSM: {backend}")
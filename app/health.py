@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from logger import logger
+from outline import get_client
+from servers import registry
+
+load_dotenv()
+
+PROBE_INTERVAL = int(os.getenv("HEALTH_PROBE_INTERVAL", "30"))  # Секунды между проверками
+FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", "3"))  # Ошибок подряд до отключения сервера
+
+
+class CircuitBreaker:
+    """Состояние одного сервера Outline.
+
+    После failure_threshold ошибок подряд размыкается, и сервер не получает
+    новых ключей, пока очередная проверка не пройдёт успешно.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD):
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.latency = None  # Сглаженная задержка ответа, секунды
+        self.last_error = None
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.failures >= self.failure_threshold
+
+    def record_success(self, latency=None):
+        if self.is_open:
+            logger.info(f"Сервер снова доступен после {self.failures} ошибок")
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def record_failure(self, error=None):
+        self.failures += 1
+        self.last_error = error
+        if self.failures == self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class HealthProber:
+    """Периодически опрашивает /server на каждом сервере и ведёт их предохранители."""
+
+    def __init__(self, interval=PROBE_INTERVAL):
+        self.interval = interval
+        self.breakers = {}
+
+    def breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker()
+        return breaker
+
+    def is_available(self, host):
+        return not self.breaker(host).is_open
+
+    def record_failure(self, host, error=None):
+        breaker = self.breaker(host)
+        breaker.record_failure(error)
+        if breaker.is_open:
+            logger.warning(f"⛔ Сервер {host} исключён из выдачи ключей: {error or 'ошибка запроса'}")
+
+    async def probe(self, server):
+        host = server["host"]
+        started = time.monotonic()
+        try:
+            await get_client(server["api_url"]).get_server_info()
+        except Exception as e:
+            self.record_failure(host, repr(e))
+            return
+        self.breaker(host).record_success(time.monotonic() - started)
+
+    async def probe_all(self):
+        """Проверяет все серверы параллельно."""
+        servers = await registry.get_servers()
+        await asyncio.gather(*(self.probe(server) for server in servers))
+
+    async def run(self):
+        """Цикл проверок для процессов без планировщика."""
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Ошибка проверки серверов: {e}")
+            await asyncio.sleep(self.interval)
+
+
+prober = HealthProber()
@@ -0,0 +1,68 @@
+import select
+import threading
+import psycopg2
+from logger import logger
+from database import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, USER_CHANGED_CHANNEL
+
+
+class UserChangeListener:
+    """Слушает NOTIFY об изменении пользователей и вызывает обработчики с telegram_id.
+
+    Уведомления шлёт database.notify_users_changed в той же транзакции, что и
+    изменение, поэтому они приходят только после commit - и в любой процесс.
+    """
+
+    def __init__(self, *callbacks, reconnect_delay=5):
+        self.callbacks = list(callbacks)
+        self.reconnect_delay = reconnect_delay
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="user-change-listener", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.reconnect_delay)
+            self._thread = None
+
+    def _dispatch(self, payload):
+        for part in payload.split(","):
+            try:
+                telegram_id = int(part)
+            except ValueError:
+                continue
+            for callback in self.callbacks:
+                try:
+                    callback(telegram_id)
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика изменения пользователя {telegram_id}: {e}")
+
+    def _listen(self):
+        connection = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+        )
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {USER_CHANGED_CHANNEL}")
+            logger.info("Подписка на изменения пользователей активна")
+            while not self._stop.is_set():
+                if select.select([connection], [], [], 1.0) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    self._dispatch(connection.notifies.pop(0).payload)
+        finally:
+            connection.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"Потеряно соединение для уведомлений об изменениях: {e}")
+                self._stop.wait(self.reconnect_delay)
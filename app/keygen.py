@@ -1,15 +1,25 @@
 from logger import logger
 import aiohttp
 from pony.orm import db_session, commit, count 
-from database import User
-from servers import load_servers_from_file, save_servers_to_file, get_available_server, add_device_to_host
+from database import User, notify_users_changed
+from servers import registry, add_device_to_host
 from datetime import datetime, timedelta
-from utils import encrypt_telegram_id, update_user_data
+from utils import update_user_data
+from tokens import sign_token, account_epoch
+from outline import get_client
+from health import prober
+from keypool import key_pool
+from profiles import invalidate_profile
+from singleflight import SingleFlight, advisory_lock
 
 HOSTS_FILE = "hosts.json"
 CONN_NAME = "AirVPN"
+KEY_REQUEST_ATTEMPTS = 2  # Сколько серверов пробуем при выдаче ключа
 DOMAIN = "e-airvpn.ru"
 
+# Выдача ключа одному пользователю из триала, оплаты и продления не должна идти параллельно
+key_issuance = SingleFlight(ttl=60)
+
 
 async def activate_trial(user_id) -> str:
     """Генерирует пробный ключ доступа"""
@@ -30,28 +40,34 @@ async def activate_trial(user_id) -> str:
         if user.trial_used:
             return "Вы уже использовали пробный ключ. Оформите подписку для дальнейшего доступа."
 
-        # Генерируем VPN-ключ
-        dynamic_key = await generate_vpn_key(user_id)
-        if not dynamic_key:
-            return "Ошибка при выдаче пробного ключа.\nПожалуйста, обратитесь в поддержку @airvpnsupport."
+    # Ключ выдаём вне сессии: вложенная сессия Pony не видит ключ, выданный
+    # другим процессом, а её commit() зафиксировал бы чужую транзакцию
+    dynamic_key = await generate_vpn_key(user_id)
+    if not dynamic_key:
+        return "Ошибка при выдаче пробного ключа.\nПожалуйста, обратитесь в поддержку @airvpnsupport."
 
-        # Первым 10 пользователям даём 7 дней, остальным 24 часа
-        end_date = datetime.now() + timedelta(days=3)
+    # Первым 10 пользователям даём 7 дней, остальным 24 часа
+    end_date = datetime.now() + timedelta(days=3)
 
-        # Обновляем данные пользователя
+    # Обновляем данные пользователя
+    with db_session:
+        user = User[user_id]
         user.trial_end_date = end_date
         user.trial_used = True
+        notify_users_changed([user_id])
 
-        commit()
-        return dynamic_key
+    invalidate_profile(user_id)
+    return dynamic_key
     
 async def generate_dynamic_key(telegram_id: int) -> str:
-    """Генерирует динамический ключ доступа для пользователя с шифрованным telegram_id."""
+    """Генерирует динамический ключ доступа для пользователя с подписанным токеном."""
     try:
-        # Шифруем telegram_id
-        encrypted_id = encrypt_telegram_id(telegram_id)
+        with db_session:
+            created_at = User[telegram_id].created_at
+        # Подписываем telegram_id вместе с эпохой учетной записи
+        token = sign_token(telegram_id, account_epoch(created_at))
         # Формируем динамический ключ
-        dynamic_key = f"ssconf://{DOMAIN}/conf/{encrypted_id}#{CONN_NAME}"
+        dynamic_key = f"ssconf://{DOMAIN}/conf/{token}#{CONN_NAME}"
         return dynamic_key
 
     except Exception as e:
@@ -59,63 +75,91 @@ async def generate_dynamic_key(telegram_id: int) -> str:
         return None
 
 
-async def request_access_key(api_url, headers, payload) -> dict:
-    """Отправляет POST-запрос на сервер Outline и возвращает данные подключения."""
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(api_url, headers=headers, json=payload, ssl=False) as response:
-                response.raise_for_status() 
-
-                data = await response.json() 
-                if data:
-                    logger.info("Есть ответ сервера")
-
-                access_key = data.get("accessUrl")
-                key_id = data.get("id")
-                server_port = data.get("port")
-                method = data.get("method")
-                password = data.get("password")
-
-                if not access_key or not key_id:
-                    return None
-
-                return {
-                    "access_key": access_key,
-                    "key_id": key_id,
-                    "server_port": server_port,
-                    "method": method,
-                    "password": password
-                }
-
-        except aiohttp.ClientResponseError as e:
-            logger.error(f"Ошибка HTTP {e.status}: {e.message}")
-        except aiohttp.ClientError as e:
-            logger.error(f"Ошибка при отправке запроса: {e}")
-        except Exception as e:
-            logger.error(f"Неизвестная ошибка: {e}")
+async def request_access_key(api_url, user_id) -> dict:
+    """Создаёт ключ на сервере Outline и возвращает данные подключения."""
+    try:
+        data = await get_client(api_url).create_access_key(str(user_id))
+        if data:
+            logger.info("Есть ответ сервера")
+
+        access_key = data.get("accessUrl")
+        key_id = data.get("id")
+        server_port = data.get("port")
+        method = data.get("method")
+        password = data.get("password")
+
+        if not access_key or not key_id:
+            return None
+
+        return {
+            "access_key": access_key,
+            "key_id": key_id,
+            "server_port": server_port,
+            "method": method,
+            "password": password
+        }
+
+    except aiohttp.ClientResponseError as e:
+        logger.error(f"Ошибка HTTP {e.status}: {e.message}")
+    except aiohttp.ClientError as e:
+        logger.error(f"Ошибка при отправке запроса: {e}")
+    except Exception as e:
+        logger.error(f"Неизвестная ошибка: {e}")
 
     return None  # Если что-то пошло не так, возвращаем None
 
 async def generate_vpn_key(user_id):
-    """Возвращает динамический ключ через бота"""
-    try:
-        logger.info(f"Начало генерации VPN-ключа для пользователя {user_id}")
+    """Возвращает динамический ключ через бота.
 
-        # Получение сервера и локации
-        servers = await load_servers_from_file('hosts.json')
-        server = get_available_server(servers)
-        if not server:
-            logger.warning(f"Не удалось найти доступный сервер для пользователя {user_id}")
-            return None
+    Параллельные вызовы для одного пользователя получают один общий ключ:
+    внутри процесса их объединяет SingleFlight, между процессами - advisory-lock.
+    """
+    return await key_issuance.do(user_id, _issue_vpn_key, user_id)
 
-        api_url = f"{server['api_url']}/access-keys"
-        headers = {"Content-Type": "application/json"}
-        payload = {"name": str(user_id)}
 
-        access_data = await request_access_key(api_url, headers, payload)
+async def _issue_vpn_key(user_id):
+    try:
+        async with advisory_lock(f"vpn_key:{user_id}") as connection:
+            # Ключ мог выдать другой процесс, пока мы ждали блокировку. Читаем на
+            # соединении с блокировкой: сессия Pony вызывающего может быть устаревшей
+            row = await connection.fetchrow(
+                'SELECT key_id, dynamic_key FROM "user" WHERE telegram_id = $1', user_id
+            )
+            if row and row["key_id"] is not None:
+                logger.info(f"У пользователя {user_id} уже есть ключ, новый не создаем")
+                return row["dynamic_key"] or await generate_dynamic_key(user_id)
+            return await _create_vpn_key(user_id)
+    except Exception as e:
+        logger.error(f"Ошибка блокировки выдачи ключа для {user_id}: {e}")
+        return None
+
 
-        if not access_data:
+async def _create_vpn_key(user_id):
+    try:
+        logger.info(f"Начало генерации VPN-ключа для пользователя {user_id}")
+
+        # Получение сервера и локации: недоступные серверы пропускаем,
+        # при ошибке пробуем следующий сервер
+        tried_hosts = set()
+        for _ in range(KEY_REQUEST_ATTEMPTS):
+            server = await registry.pick_server(
+                lambda host: host not in tried_hosts and prober.is_available(host)
+            )
+            if not server:
+                logger.warning(f"Не удалось найти доступный сервер для пользователя {user_id}")
+                return None
+            tried_hosts.add(server['host'])
+
+            # Готовый ключ из пула выдаётся сразу, иначе создаём его на сервере
+            access_data = await key_pool.claim(server, user_id)
+            if not access_data:
+                access_data = await request_access_key(server['api_url'], user_id)
+            if access_data:
+                break
+
+            prober.record_failure(server['host'])
             logger.error(f"Ошибка: сервер {server['host']} не вернул данные доступа для {user_id}")
+        else:
             return None
 
         # Преобразуем данные в нужные типы
@@ -170,48 +214,38 @@ async def delete_vpn_key(key_id):
                 logger.error(f"Для пользователя {user.telegram_id} не найден сервер для удаления ключа.")
                 return False
 
-        servers = await load_servers_from_file('hosts.json')
-        if not servers:
-            logger.info("Нет доступных серверов для удаления ключа.")
-            return False
-
-        server = next((s for s in servers if s['host'] == host), None)
+        server = await registry.get_server(host)
         if not server:
             logger.error(f"Не удалось найти сервер с IP {host} в списке серверов.")
             return False
 
-        api_url = f"{server['api_url']}/access-keys/{vpn_key_id}"
-        headers = {"Content-Type": "application/json"}
-
-        async with aiohttp.ClientSession() as session:
-            try:
-                logger.info(f"Отправка DELETE запроса на сервер Outline для удаления ключа {vpn_key_id} пользователя {user.telegram_id}...")
-                async with session.delete(api_url, headers=headers, ssl=False) as response:
-                    if response.status == 204:  
-                        logger.info(f"Ключ {vpn_key_id} пользователя {user.telegram_id} успешно удален.")
-                        
-                        server['current_devices'] -= 1
-                        await save_servers_to_file('hosts.json', servers)
-
-                        with db_session:
-                            # Получаем пользователя
-                            user = User.get(key_id=key_id)
-                            if user:
-                                # Удаляем данные VPN-ключа, но не трогаем подписку
-                                user.access_key = None
-                                user.key_id = None
-                                user.host = None
-                                user.server_port = None
-                                user.password = None
-                                user.method = None
-
-                                commit()
-
-                        return True
-                    else:
-                        logger.error(f"Ошибка удаления ключа: {response.status} {await response.text()}")
-            except aiohttp.ClientError as e:
-                logger.error(f"Ошибка при отправке DELETE запроса: {e}")
+        try:
+            logger.info(f"Отправка DELETE запроса на сервер Outline для удаления ключа {vpn_key_id} пользователя {user.telegram_id}...")
+            status = await get_client(server['api_url']).delete_access_key(vpn_key_id)
+            if status == 204:
+                logger.info(f"Ключ {vpn_key_id} пользователя {user.telegram_id} успешно удален.")
+
+                await add_device_to_host(host, -1)
+
+                with db_session:
+                    # Получаем пользователя
+                    user = User.get(key_id=key_id)
+                    if user:
+                        # Удаляем данные VPN-ключа, но не трогаем подписку
+                        user.access_key = None
+                        user.key_id = None
+                        user.host = None
+                        user.server_port = None
+                        user.password = None
+                        user.method = None
+                        notify_users_changed([user.telegram_id])
+
+                        commit()
+                        invalidate_profile(user.telegram_id)
+
+                return True
+        except aiohttp.ClientError as e:
+            logger.error(f"Ошибка при отправке DELETE запроса: {e}")
 
     except Exception as e:
         logger.error(f"Общая ошибка: {e}")
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from logger import logger
+from database import add_pooled_key, claim_pooled_key, get_pool_sizes, get_unassigned_keys
+from outline import get_client
+from servers import registry
+from health import prober
+from singleflight import try_advisory_lock
+
+load_dotenv()
+
+POOL_SIZE = int(os.getenv("KEY_POOL_SIZE", "5"))  # Свободных ключей на каждом сервере
+REFILL_INTERVAL = int(os.getenv("KEY_POOL_REFILL_INTERVAL", "60"))  # Секунды между пополнениями
+POOL_KEY_NAME = "pool"
+ORPHAN_GRACE = 300  # Секунды, после которых ничей ключ "pool" возвращается в пул
+
+
+class KeyPool:
+    """Пул заранее созданных ключей Outline.
+
+    Выдача ключа забирает готовую строку из БД и переименовывает ключ в фоне,
+    поэтому пользователь не ждёт POST /access-keys. Пул общий для бота и API.
+    Пополняет его один процесс за раз (advisory-блокировка key_pool_refill).
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+        self._orphans = {}  # сервер -> {key_id: когда впервые найден ничьим}
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def claim(self, server, user_id):
+        """Возвращает данные подключения из пула или None, если пул сервера пуст."""
+        if self.size <= 0:
+            return None
+        # В отдельном потоке: своя сессия Pony и своя транзакция, а не открытая у вызывающего
+        access_data = await asyncio.to_thread(claim_pooled_key, server["host"])
+        if access_data is None:
+            logger.info(f"Пул ключей сервера {server['host']} пуст")
+            return None
+        self._spawn(self._rename(server, access_data["key_id"], user_id))
+        self._spawn(self.refill())
+        return access_data
+
+    async def _rename(self, server, key_id, user_id):
+        try:
+            await get_client(server["api_url"]).rename_access_key(key_id, str(user_id))
+        except Exception as e:
+            # Имя ключа справочное, ключ уже работает
+            logger.warning(f"Не удалось переименовать ключ {key_id} на {server['host']}: {e}")
+
+    async def refill(self, reconcile=False):
+        """Дополняет пул каждого доступного сервера до size ключей.
+
+        reconcile - сначала вернуть в пул ключи, созданные на сервере, но не
+        записанные в БД (процесс упал между созданием ключа и записью).
+        """
+        if self.size <= 0 or self._lock.locked():
+            return
+        async with self._lock, try_advisory_lock("key_pool_refill") as acquired:
+            if not acquired:
+                return  # Пул сейчас пополняет другой процесс
+            servers = [server for server in await registry.get_servers() if prober.is_available(server["host"])]
+            if reconcile:
+                await asyncio.gather(*(self._adopt_orphans(server) for server in servers))
+            sizes = await asyncio.to_thread(get_pool_sizes)
+            await asyncio.gather(*(
+                self._fill(server, self.size - sizes.get(server["host"], 0))
+                for server in servers
+            ))
+
+    async def _adopt_orphans(self, server):
+        host = server["host"]
+        try:
+            keys = await get_client(server["api_url"]).list_access_keys()
+            pool_keys = {int(key["id"]): key for key in keys if key.get("name") == POOL_KEY_NAME}
+            orphans = await asyncio.to_thread(get_unassigned_keys, host, pool_keys)
+            # Только что выданный из пула ключ ещё не записан пользователю и не
+            # переименован: возвращаем ключ, только если он ничей дольше ORPHAN_GRACE
+            now = time.monotonic()
+            first_seen = self._orphans.get(host, {})
+            first_seen = self._orphans[host] = {key_id: first_seen.get(key_id, now) for key_id in orphans}
+            for key_id, seen in list(first_seen.items()):
+                if now - seen >= ORPHAN_GRACE:
+                    await asyncio.to_thread(add_pooled_key, host, pool_keys[key_id])
+                    del first_seen[key_id]
+                    logger.warning(f"Ключ {key_id} на {host} не был записан в пул, возвращён в пул")
+        except Exception as e:
+            logger.error(f"Ошибка сверки пула ключей сервера {host}: {e}")
+
+    async def _fill(self, server, missing):
+        client = get_client(server["api_url"])
+        for _ in range(missing):
+            try:
+                data = await client.create_access_key(POOL_KEY_NAME)
+                await asyncio.to_thread(add_pooled_key, server["host"], data)
+            except Exception as e:
+                prober.record_failure(server["host"], repr(e))
+                logger.error(f"Ошибка пополнения пула ключей сервера {server['host']}: {e}")
+                return
+        if missing > 0:
+            logger.info(f"🔑 Пул ключей сервера {server['host']} пополнен на {missing}")
+
+    async def stop(self):
+        """Дожидается фоновых переименований и пополнений."""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+key_pool = KeyPool()
@@ -1,20 +1,106 @@
+import atexit
+import json
 import logging
+import os
+import queue
 import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+from dotenv import load_dotenv
 
-logger = logging.getLogger("vpn_bot")
+load_dotenv()
 
-if not logger.hasHandlers():
-    logger.setLevel(logging.INFO) 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler = logging.FileHandler('bot.log', encoding='utf-8')
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json
 
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(formatter)
-    console_handler.setLevel(logging.INFO)
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+_listeners = {}
 
-    logger.propagate = False
\ No newline at end of file
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись - для сбора логов в Loki/ELK."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(QueueHandler):
+    """Кладёт запись в очередь, не форматируя её в вызывающем потоке.
+
+    Стандартный QueueHandler сразу склеивает сообщение со стеком исключения,
+    и JSON-формат терял бы поле exception; здесь стек сохраняется в exc_text.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _file_handler(filename):
+    # В bot.log пишут бот, каждый воркер вебхука и API (через общие модули). Ротация
+    # средствами logging в каждом процессе своя и теряет записи, поэтому файл
+    # ротирует logrotate, а WatchedFileHandler переоткрывает его после переименования.
+    return WatchedFileHandler(filename, encoding="utf-8")
+
+
+def setup_logger(name, filename, console=True, level=logging.INFO):
+    """Логгер, который пишет в файл и консоль из отдельного потока.
+
+    Вызов logger.info только кладёт запись в очередь, поэтому запись на диск
+    не задерживает event loop. Ротация файлов - внешняя (logrotate).
+    """
+    logger = logging.getLogger(name)
+    if name in _listeners or logger.handlers:
+        return logger
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [_file_handler(filename)]
+    if console:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners[name] = listener
+
+    logger.setLevel(level)
+    logger.handlers = [_QueueHandler(log_queue)]
+    logger.propagate = False
+    return logger
+
+
+def stop_logger(name):
+    """Дописывает очередь логгера и останавливает его поток."""
+    listener = _listeners.pop(name, None)
+    if listener:
+        logging.getLogger(name).handlers = []
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+@atexit.register
+def _stop_all():
+    for name in list(_listeners):
+        stop_logger(name)
+
+
+logger = setup_logger("vpn_bot", "bot.log")
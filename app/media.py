@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import tempfile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto
+from aiogram.types.input_file import FSInputFile
+from dotenv import load_dotenv
+from logger import logger
+
+load_dotenv()
+
+MEDIA_CACHE_FILE = os.getenv("MEDIA_CACHE_FILE", "media_cache.json")
+# Чат, куда при запуске загружаются ещё не закэшированные картинки (обычно чат администратора)
+MEDIA_WARMUP_CHAT_ID = os.getenv("MEDIA_WARMUP_CHAT_ID")
+# Ошибки, после которых file_id больше не годится и файл надо загрузить заново
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference", "file_reference")
+
+
+class MediaCache:
+    """Кэш file_id Telegram для локальных картинок.
+
+    Каждая картинка загружается один раз, дальше отправляется по file_id.
+    Ключ - путь и sha256 содержимого, поэтому заменённый файл загрузится заново.
+    """
+
+    def __init__(self, store_path=MEDIA_CACHE_FILE):
+        self.store_path = store_path
+        self._file_ids = self._load()
+        self._hashes = {}  # путь -> (mtime, размер, sha256), чтобы не читать файл на каждый клик
+
+    def _load(self):
+        try:
+            with open(self.store_path, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать кэш file_id {self.store_path}: {e}")
+            return {}
+
+    def _save(self):
+        # Свой временный файл на каждую запись: в режиме вебхука файл общий у нескольких воркеров
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.store_path)), prefix=f"{os.path.basename(self.store_path)}.", suffix=".tmp"
+        )
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(self._file_ids, file, indent=4)
+        os.replace(tmp_path, self.store_path)
+
+    def _key(self, path):
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+            with open(path, "rb") as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            cached = self._hashes[path] = (stat.st_mtime, stat.st_size, digest)
+        return f"{path}:{cached[2]}"
+
+    def get(self, path):
+        """file_id для отправки или FSInputFile, если картинка ещё не загружалась."""
+        return self._file_ids.get(self._key(path)) or FSInputFile(path)
+
+    def remember(self, path, message):
+        """Сохраняет file_id из отправленного сообщения с фото."""
+        if not getattr(message, "photo", None):
+            return
+        key = self._key(path)
+        file_id = message.photo[-1].file_id
+        if self._file_ids.get(key) != file_id:
+            self._file_ids[key] = file_id
+            self._save()
+
+    def forget(self, path):
+        if self._file_ids.pop(self._key(path), None) is not None:
+            self._save()
+
+    async def _send(self, path, send):
+        media = self.get(path)
+        try:
+            message = await send(media)
+        except TelegramBadRequest as e:
+            # Остальные ошибки (например, "message is not modified") к file_id не относятся
+            if isinstance(media, FSInputFile) or not any(error in e.message.lower() for error in FILE_ID_ERRORS):
+                raise
+            # file_id от другого бота или устарел - загружаем файл заново
+            logger.warning(f"file_id для {path} не принят Telegram: {e}")
+            self.forget(path)
+            message = await send(FSInputFile(path))
+        self.remember(path, message)
+        return message
+
+    async def answer_photo(self, message, path, **kwargs):
+        return await self._send(path, lambda media: message.answer_photo(media, **kwargs))
+
+    async def edit_photo(self, bot, chat_id, message_id, path, **kwargs):
+        return await self._send(path, lambda media: bot.edit_message_media(
+            media=InputMediaPhoto(media=media), chat_id=chat_id, message_id=message_id, **kwargs
+        ))
+
+    async def warm_up(self, bot, paths, chat_id=MEDIA_WARMUP_CHAT_ID):
+        """Загружает картинки без file_id заранее, чтобы первый пользователь не ждал."""
+        if not chat_id:
+            return
+        for path in paths:
+            if not os.path.exists(path) or isinstance(self.get(path), str):
+                continue
+            try:
+                message = await bot.send_photo(chat_id, FSInputFile(path), disable_notification=True)
+                self.remember(path, message)
+                await bot.delete_message(chat_id, message.message_id)
+            except Exception as e:
+                logger.error(f"Не удалось заранее загрузить {path}: {e}")
+                return
+        logger.info("🖼 Картинки инструкции загружены в Telegram.")
+
+
+media_cache = MediaCache()
@@ -0,0 +1,215 @@
+"""Метрики в текстовом формате Prometheus.
+
+API отдаёт их на /metrics. Бот работает отдельным процессом (или несколькими
+в режиме вебхука), поэтому каждый процесс бота периодически пишет свои
+значения в файл-снимок, а API добавляет их к своим с меткой process.
+"""
+import asyncio
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from aiogram import BaseMiddleware
+from dotenv import load_dotenv
+from logger import logger
+
+load_dotenv()
+
+SNAPSHOT_FILE = os.getenv("METRICS_SNAPSHOT_FILE", "bot_metrics.json")
+SNAPSHOT_INTERVAL = 15  # Секунды между записями снимка бота
+SNAPSHOT_MAX_AGE = 120  # Более старый снимок считаем остановленным ботом
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with (в том числе с await внутри)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            result = []
+            for key, (counts, total, count) in self._values.items():
+                labels = self._labels(key)
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    result.append((f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative))
+                result.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, count))
+                result.append((f"{self.name}_sum", labels, total))
+                result.append((f"{self.name}_count", labels, count))
+            return result
+
+
+HANDLER_LATENCY = Histogram("vpn_bot_handler_seconds", "Время обработки апдейта хендлером aiogram", ["handler"])
+CONF_LATENCY = Histogram("vpn_api_conf_seconds", "Время ответа /conf", ["status"])
+OUTLINE_LATENCY = Histogram("vpn_outline_request_seconds", "Время запроса к Outline Management API", ["server", "method"])
+YOOKASSA_LATENCY = Histogram("vpn_yookassa_request_seconds", "Время запроса к API ЮKassa", ["call"])
+DB_QUERY_LATENCY = Histogram("vpn_db_query_seconds", "Время SQL-запросов Pony")
+PENDING_PAYMENTS = Gauge("vpn_pending_payments", "Платежи, ожидающие подтверждения")
+SERVER_DEVICES = Gauge("vpn_server_devices", "Выданные ключи на сервере", ["server"])
+SERVER_CAPACITY = Gauge("vpn_server_max_devices", "Лимит ключей на сервере", ["server"])
+LOOP_LAG = Gauge("vpn_event_loop_lag_seconds", "Задержка event loop относительно расписания")
+
+
+def collect() -> dict:
+    """Текущие значения метрик процесса: {имя метрики: [(имя, метки, значение), ...]}."""
+    return {metric.name: metric.samples() for metric in _metrics}
+
+
+def render(process, snapshots=None) -> str:
+    """Текст для /metrics: свои метрики и снимки других процессов с меткой process."""
+    sources = {process: collect(), **(snapshots or {})}
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for source, values in sources.items():
+            for name, labels, value in values.get(metric.name, []):
+                lines.append(f"{name}{_format_labels({'process': source, **labels})} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(path=SNAPSHOT_FILE):
+    """Сохраняет метрики процесса в файл (атомарно, через временный файл)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"written_at": time.time(), "metrics": collect()}, file)
+    os.replace(tmp_path, path)
+
+
+def snapshot_path(worker=None):
+    """Файл снимка процесса бота; у воркеров вебхука, кроме основного (0), свой файл на каждый.
+
+    Основной процесс (polling или воркер 0) попадает в /metrics как process="bot", воркер N - как "bot-N".
+    """
+    if not worker:
+        return SNAPSHOT_FILE
+    root, ext = os.path.splitext(SNAPSHOT_FILE)
+    return f"{root}.{worker}{ext}"
+
+
+def read_snapshot(path=SNAPSHOT_FILE):
+    """Читает снимок другого процесса; устаревший или отсутствующий снимок - None."""
+    try:
+        with open(path, encoding="utf-8") as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - snapshot.get("written_at", 0) > SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot["metrics"]
+
+
+def read_snapshots():
+    """Свежие снимки всех процессов бота: {"bot": ..., "bot-1": ...}."""
+    root, ext = os.path.splitext(SNAPSHOT_FILE)
+    snapshots = {}
+    for path in [SNAPSHOT_FILE, *sorted(glob.glob(f"{glob.escape(root)}.*{ext}"))]:
+        values = read_snapshot(path)
+        if values is not None:
+            worker = path[len(root) + 1:-len(ext) or None] if path != SNAPSHOT_FILE else ""
+            snapshots[f"bot-{worker}" if worker else "bot"] = values
+    return snapshots
+
+
+async def run_snapshots(path, interval=SNAPSHOT_INTERVAL):
+    """Периодически пишет снимок метрик процесса."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            write_snapshot(path)
+        except OSError as e:
+            logger.warning(f"Не удалось записать снимок метрик {path}: {e}")
+
+
+async def monitor_loop_lag(interval=1.0):
+    """Измеряет, насколько позже запланированного просыпается event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.set(max(loop.time() - started - interval, 0.0))
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Замеряет время хендлеров роутера (подключается как inner-middleware)."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        with HANDLER_LATENCY.time(handler=name):
+            return await handler(event, data)
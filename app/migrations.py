@@ -0,0 +1,149 @@
+"""Версионные миграции схемы и аудит планов горячих запросов.
+
+Pony создаёт только недостающие таблицы, поэтому колонки и индексы для уже
+существующей базы добавляются здесь. Каждая миграция применяется один раз
+и записывается в schema_version; бот и API могут стартовать одновременно -
+advisory-lock не даёт им применить миграцию дважды.
+
+    python migrations.py status                 # текущая версия схемы
+    python migrations.py audit [--no-seqscan]   # EXPLAIN горячих запросов
+"""
+import argparse
+import json
+from logger import logger
+
+MIGRATIONS_LOCK_ID = 7311  # Ключ pg_advisory_xact_lock для миграций
+
+# (версия, описание, SQL-команды). Уже применённые миграции не меняем - только добавляем новые.
+MIGRATIONS = [
+    (1, "Колонка user.last_notified_at", [
+        'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS last_notified_at TIMESTAMP',
+    ]),
+    (2, "Индексы для выдачи ключей, проверки подписок и платежей", [
+        # delete_vpn_key: User.get(key_id=...)
+        'CREATE INDEX IF NOT EXISTS idx_user_key_id ON "user" (key_id)',
+        # Учет устройств на серверах: GROUP BY host
+        'CREATE INDEX IF NOT EXISTS idx_user_host ON "user" (host) WHERE key_id IS NOT NULL',
+        # Истекшие и истекающие подписки
+        'CREATE INDEX IF NOT EXISTS idx_user_subscription_end ON "user" (subscription_end) WHERE key_id IS NOT NULL',
+        # Истекшие пробные периоды
+        'CREATE INDEX IF NOT EXISTS idx_user_trial_end_date ON "user" (trial_end_date) '
+        'WHERE key_id IS NOT NULL AND subscription_end IS NULL',
+        # Рекламные напоминания: пользователи без пробного ключа и подписки
+        'CREATE INDEX IF NOT EXISTS idx_user_notification_targets ON "user" (telegram_id) '
+        'WHERE NOT trial_used AND subscription_end IS NULL',
+        'CREATE INDEX IF NOT EXISTS idx_subscription_user_status ON subscription ("user", status)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_user_date ON payment ("user", payment_date)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_date ON payment (payment_date)',
+        'CREATE INDEX IF NOT EXISTS idx_pendingpayment_status ON pendingpayment (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_pooledkey_host ON pooledkey (host)',
+    ]),
+]
+
+# Запросы, которые выполняются на каждый запрос пользователя или в регулярных задачах
+HOT_QUERIES = [
+    ("conf", 'SELECT host, server_port, password, method, subscription_end, started, created_at '
+             'FROM "user" WHERE telegram_id = 1'),
+    ("delete_vpn_key", 'SELECT * FROM "user" WHERE key_id = 1'),
+    ("expired_trials", 'SELECT telegram_id, key_id, host FROM "user" WHERE trial_used AND trial_end_date <= now() '
+                       'AND subscription_end IS NULL AND key_id IS NOT NULL'),
+    ("expired_subscriptions", 'SELECT telegram_id, key_id, host FROM "user" '
+                              'WHERE subscription_end <= now() AND key_id IS NOT NULL'),
+    ("expiring_subscriptions", 'SELECT telegram_id, subscription_end FROM "user" WHERE subscription_end > now() '
+                               "AND subscription_end <= now() + interval '3 days' AND key_id IS NOT NULL"),
+    ("server_usage", 'SELECT host, count(*) FROM "user" WHERE host IS NOT NULL AND key_id IS NOT NULL GROUP BY host'),
+    ("notification_targets", 'SELECT telegram_id FROM "user" WHERE NOT trial_used AND subscription_end IS NULL '
+                             'AND telegram_id > 0 ORDER BY telegram_id LIMIT 500'),
+    ("active_subscription", "SELECT * FROM subscription WHERE \"user\" = 1 AND status = 'Active'"),
+    ("user_payments", 'SELECT * FROM payment WHERE "user" = 1 ORDER BY payment_date'),
+    ("pending_payments", "SELECT * FROM pendingpayment WHERE status = 'pending'"),
+    ("claim_pooled_key", "SELECT * FROM pooledkey WHERE host = '' ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"),
+]
+
+
+def pending_migrations(applied_versions, migrations=MIGRATIONS):
+    """Миграции, которых ещё нет в schema_version, по возрастанию версии."""
+    applied = set(applied_versions)
+    return sorted((m for m in migrations if m[0] not in applied), key=lambda m: m[0])
+
+
+def apply_migrations(db):
+    """Применяет недостающие миграции; вызывается из database.py при запуске."""
+    from pony.orm import db_session
+
+    with db_session:
+        # Сначала блокировка: параллельный CREATE TABLE IF NOT EXISTS из бота и API
+        # может упасть на уникальном индексе pg_type
+        db.execute(f"SELECT pg_advisory_xact_lock({MIGRATIONS_LOCK_ID})")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT now())"
+        )
+        for version, name, statements in pending_migrations(db.select("SELECT version FROM schema_version")):
+            for statement in statements:
+                db.execute(statement)
+            db.execute(
+                "INSERT INTO schema_version (version, name) VALUES ($version, $name)",
+                {"version": version, "name": name}
+            )
+            logger.info(f"🗄 Применена миграция {version}: {name}")
+
+
+def find_seq_scans(plan):
+    """Возвращает (таблица, оценка строк) для всех узлов Seq Scan в плане EXPLAIN (FORMAT JSON)."""
+    scans = []
+    if plan.get("Node Type") == "Seq Scan":
+        scans.append((plan.get("Relation Name"), plan.get("Plan Rows")))
+    for child in plan.get("Plans", []):
+        scans.extend(find_seq_scans(child))
+    return scans
+
+
+def audit(db, no_seqscan=False):
+    """Выполняет EXPLAIN горячих запросов и сообщает о последовательных сканированиях.
+
+    На маленьких таблицах планировщик честно выбирает Seq Scan; с no_seqscan
+    он вынужден взять индекс, и оставшиеся Seq Scan означают, что индекса нет.
+    """
+    from pony.orm import db_session, rollback
+
+    problems = 0
+    with db_session:
+        if no_seqscan:
+            db.execute("SET LOCAL enable_seqscan = off")
+        for name, query in HOT_QUERIES:
+            raw = db.select(f"EXPLAIN (FORMAT JSON) {query}")[0]
+            plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+            scans = find_seq_scans(plan)
+            if scans:
+                problems += 1
+                details = ", ".join(f"{table} (~{rows} строк)" for table, rows in scans)
+                print(f"⚠️  {name}: Seq Scan по {details}")
+            else:
+                print(f"✅ {name}: {plan['Node Type']}")
+        rollback()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы и аудит запросов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="показать применённые миграции")
+    audit_parser = subparsers.add_parser("audit", help="найти Seq Scan в горячих запросах")
+    audit_parser.add_argument("--no-seqscan", action="store_true", help="запретить планировщику Seq Scan")
+    args = parser.parse_args()
+
+    # Импорт database применяет недостающие миграции
+    from pony.orm import db_session
+    from database import db
+
+    if args.command == "status":
+        with db_session:
+            for version, name, applied_at in db.select("SELECT version, name, applied_at FROM schema_version ORDER BY version"):
+                print(f"{version}: {name} ({applied_at:%d.%m.%Y %H:%M})")
+    else:
+        raise SystemExit(1 if audit(db, args.no_seqscan) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import asyncio
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNetworkError, TelegramServerError,
+)
+from logger import logger
+from ratelimit import TokenBucket, KeyedBuckets
+
+# Лимиты Telegram: около 30 сообщений в секунду всего и 1 в секунду в один чат
+GLOBAL_RATE = 25
+PER_CHAT_RATE = 1
+SEND_ATTEMPTS = 3
+
+global_bucket = TokenBucket(GLOBAL_RATE)
+chat_buckets = KeyedBuckets(PER_CHAT_RATE)
+
+
+async def send_message(bot, chat_id, text, **kwargs) -> bool:
+    """Отправляет сообщение с учетом лимитов Telegram.
+
+    После RetryAfter паузу выдерживают все отправители (через global_bucket), и
+    такой повтор не считается попыткой. SEND_ATTEMPTS - только на сбои сети и Telegram.
+    """
+    attempts = 0
+    while attempts < SEND_ATTEMPTS:
+        await chat_buckets.get(chat_id).acquire()
+        await global_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в {chat_id}")
+            global_bucket.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чат недоступен - повтор не поможет
+            logger.info(f"Сообщение пользователю {chat_id} не доставлено: {e}")
+            return False
+        except (TelegramNetworkError, TelegramServerError) as e:
+            attempts += 1
+            logger.warning(f"Сбой при отправке пользователю {chat_id} (попытка {attempts}): {e}")
+        except Exception as e:
+            logger.error(f"❌ Не удалось отправить сообщение пользователю {chat_id}: {e}")
+            return False
+    return False
+
+
+class NotificationQueue:
+    """Очередь исходящих сообщений: фоновые отправители вместо await в цикле."""
+
+    def __init__(self, bot, workers=4):
+        self.bot = bot
+        self.workers = workers
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Дожидается отправки очереди и останавливает отправителей."""
+        if not self._tasks:
+            return
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, chat_id, text, **kwargs):
+        self._queue.put_nowait((chat_id, text, kwargs))
+
+    async def drain(self):
+        """Ждёт, пока всё поставленное в очередь будет отправлено."""
+        await self._queue.join()
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs = await self._queue.get()
+            try:
+                await send_message(self.bot, chat_id, text, **kwargs)
+            finally:
+                self._queue.task_done()
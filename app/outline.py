@@ -0,0 +1,99 @@
+import aiohttp
+import os
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+from logger import logger
+from metrics import OUTLINE_LATENCY
+
+load_dotenv()
+
+# Ограничения пула соединений к одному серверу Outline
+CONNECTIONS_PER_HOST = int(os.getenv("OUTLINE_CONNECTIONS_PER_HOST", "10"))
+KEEPALIVE_TIMEOUT = 60  # Сколько секунд держим простаивающее соединение
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+PROBE_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=3)
+
+
+class OutlineClient:
+    """Клиент Outline Management API с постоянной сессией и keep-alive."""
+
+    def __init__(self, api_url: str):
+        self.api_url = api_url.rstrip("/")
+        self.host = urlparse(self.api_url).hostname or self.api_url
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Создаёт сессию при первом запросе (нужен запущенный event loop)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=CONNECTIONS_PER_HOST,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ssl=False,  # Outline использует самоподписанный сертификат
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=REQUEST_TIMEOUT,
+                headers={"Content-Type": "application/json"},
+            )
+        return self._session
+
+    async def get_server_info(self) -> dict:
+        """Возвращает информацию о сервере (используется для проверки доступности)."""
+        session = self._get_session()
+        with OUTLINE_LATENCY.time(server=self.host, method="server"):
+            async with session.get(f"{self.api_url}/server", timeout=PROBE_TIMEOUT) as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def list_access_keys(self) -> list:
+        """Возвращает все ключи доступа сервера."""
+        session = self._get_session()
+        with OUTLINE_LATENCY.time(server=self.host, method="list"):
+            async with session.get(f"{self.api_url}/access-keys") as response:
+                response.raise_for_status()
+                return (await response.json()).get("accessKeys", [])
+
+    async def create_access_key(self, name: str) -> dict:
+        """Создаёт ключ доступа и возвращает ответ сервера."""
+        session = self._get_session()
+        with OUTLINE_LATENCY.time(server=self.host, method="create"):
+            async with session.post(f"{self.api_url}/access-keys", json={"name": name}) as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def rename_access_key(self, key_id, name: str):
+        """Меняет имя ключа доступа."""
+        session = self._get_session()
+        with OUTLINE_LATENCY.time(server=self.host, method="rename"):
+            async with session.put(f"{self.api_url}/access-keys/{key_id}/name", json={"name": name}) as response:
+                response.raise_for_status()
+
+    async def delete_access_key(self, key_id) -> int:
+        """Удаляет ключ доступа и возвращает HTTP-статус."""
+        session = self._get_session()
+        with OUTLINE_LATENCY.time(server=self.host, method="delete"):
+            async with session.delete(f"{self.api_url}/access-keys/{key_id}") as response:
+                if response.status != 204:
+                    logger.error(f"Ошибка удаления ключа {key_id}: {response.status} {await response.text()}")
+                return response.status
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+_clients = {}
+
+def get_client(api_url: str) -> OutlineClient:
+    """Возвращает общий клиент для сервера Outline (один пул соединений на сервер)."""
+    client = _clients.get(api_url)
+    if client is None:
+        client = _clients[api_url] = OutlineClient(api_url)
+    return client
+
+async def close_clients():
+    """Закрывает все сессии при остановке бота."""
+    for client in list(_clients.values()):
+        await client.close()
+    _clients.clear()
+    logger.info("Сессии Outline закрыты.")
@@ -3,7 +3,9 @@ import uuid
 from dotenv import load_dotenv
 import os
 from logger import logger
+from metrics import YOOKASSA_LATENCY
 import asyncio
+from datetime import timezone
 
 
 load_dotenv()
@@ -11,28 +13,30 @@ load_dotenv()
 Configuration.account_id = os.getenv("TEST_SHOP_ID")  # Идентификатор магазина
 Configuration.secret_key = os.getenv("TEST_SECRET_KEY")  # Секретный ключ
 
-async def create_payment(amount, description, user_id):
+async def create_payment(amount, description, user_id, days):
     """Создаем платеж через Юкассу"""
     try:
         
         idempotence_key = str(uuid.uuid4())
       
         logger.info(f"Создаем платеж для {user_id}")
-        payment = await asyncio.to_thread(Payment.create, {
-            "amount": {
-                "value": f"{amount:.2f}",  # Сумма с двумя знаками после запятой
-                "currency": "RUB"
-            },
-            "confirmation": {
-                "type": "redirect",
-                "return_url": f"https://t.me/ishowspeedvpnbot?start={user_id}"
-            },
-            "capture": True,
-            "description": description,
-            "metadata": {
-                "user_id": str(user_id)  # Добавляем ID пользователя
-            }
-        }, idempotence_key)
+        with YOOKASSA_LATENCY.time(call="create"):
+            payment = await asyncio.to_thread(Payment.create, {
+                "amount": {
+                    "value": f"{amount:.2f}",  # Сумма с двумя знаками после запятой
+                    "currency": "RUB"
+                },
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": f"https://t.me/ishowspeedvpnbot?start={user_id}"
+                },
+                "capture": True,
+                "description": description,
+                "metadata": {
+                    "user_id": str(user_id),  # Добавляем ID пользователя
+                    "days": str(days)  # Срок подписки нужен обработчику вебхука
+                }
+            }, idempotence_key)
         
         logger.info("Возвращаю данные платежа...")
         return payment.confirmation.confirmation_url, payment.id  # URL для оплаты и ID платежа
@@ -41,27 +45,32 @@ async def create_payment(amount, description, user_id):
         return None, None
 
 
-logged_payments = {}
-
-async def get_payment_status(payment_id):
-    """Возвращаем статус платежа"""
+async def get_payment(payment_id):
+    """Возвращаем платеж из ЮKassa"""
     try:
-        if payment_id not in logged_payments:
-            logger.info(f"Проверяю статус платежа")
-            logged_payments[payment_id] = True  # Отмечаем, что лог уже был выведен
-
-        payment = await asyncio.to_thread(Payment.find_one, payment_id)
-        
-        if payment:
-            if payment.status == 'succeeded':
-                logger.info(f"Платеж успешно завершен.")
-                return payment.status  # Return status ('pending', 'succeeded', 'canceled')
-            return payment.status
-            
-        else:
-            logger.warning(f"Платеж с ID {payment_id} не найден.")
-            return None
+        with YOOKASSA_LATENCY.time(call="find_one"):
+            return await asyncio.to_thread(Payment.find_one, payment_id)
+    except Exception as e:
+        logger.error(f"Ошибка при получении платежа ID {payment_id}: {e}")
+        return None
 
+async def list_payments_since(created_since):
+    """Возвращаем все платежи, созданные после created_since, постранично (словарь id -> платеж)"""
+    params = {
+        "created_at.gte": created_since.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "limit": 100,  # Максимальный размер страницы в API
+    }
+    payments = {}
+    try:
+        while True:
+            with YOOKASSA_LATENCY.time(call="list"):
+                page = await asyncio.to_thread(Payment.list, params)
+            for payment in page.items or []:
+                payments[payment.id] = payment
+            if not page.next_cursor:
+                break
+            params["cursor"] = page.next_cursor
     except Exception as e:
-        logger.error(f"Ошибка при проверке статуса для платежа ID {payment_id}: {e}")
+        logger.error(f"Ошибка при получении списка платежей: {e}")
         return None
+    return payments
@@ -0,0 +1,53 @@
+import asyncio
+import asyncpg
+import os
+from dotenv import load_dotenv
+from database import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+load_dotenv()
+
+POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+
+_pool = None
+_pool_lock = None
+
+
+async def get_pool() -> asyncpg.Pool:
+    """Возвращает общий асинхронный пул соединений к Postgres (создаётся при первом вызове)."""
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    # Первые одновременные запросы после запуска не должны создать по пулу каждый
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                host=DB_HOST,
+                port=int(DB_PORT),
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+            )
+    return _pool
+
+
+async def connect() -> asyncpg.Connection:
+    """Отдельное соединение вне пула - для долгих сессионных блокировок."""
+    return await asyncpg.connect(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+    )
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
@@ -0,0 +1,98 @@
+import heapq
+import itertools
+
+LEAST_UTILIZED = "least_utilized"  # Наименьшая доля занятых мест
+WEIGHTED = "weighted"  # Наименьшая нагрузка на единицу заявленной пропускной способности
+ROUND_ROBIN = "round_robin"  # По кругу среди серверов со свободными местами
+
+STRATEGIES = (LEAST_UTILIZED, WEIGHTED, ROUND_ROBIN)
+
+
+class PlacementEngine:
+    """Выбор сервера для нового ключа.
+
+    Серверы со свободными местами лежат в куче по оценке стратегии, поэтому
+    выбор и обновление стоят O(log n). Устаревшие записи кучи не удаляются
+    сразу, а отбрасываются при извлечении.
+    """
+
+    def __init__(self, strategy=LEAST_UTILIZED):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Неизвестная стратегия размещения: {strategy}")
+        self.strategy = strategy
+        self._heap = []
+        self._entries = {}  # host -> актуальная запись кучи
+        self._servers = {}
+        self._counter = itertools.count()
+
+    def _score(self, server):
+        current, maximum = server["current_devices"], server["max_devices"]
+        if self.strategy == WEIGHTED:
+            bandwidth = server.get("bandwidth") or maximum
+            return current / bandwidth
+        if self.strategy == ROUND_ROBIN:
+            previous = self._entries.get(server["host"])
+            return previous[0] if previous else -1
+        return current / maximum
+
+    def _push(self, host, score):
+        entry = (score, next(self._counter), host)
+        self._entries[host] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            # Слишком много устаревших записей - пересобираем кучу
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def rebuild(self, servers):
+        """Полностью пересобирает индекс по списку серверов."""
+        self._heap = []
+        self._entries = {}
+        self._servers = {server["host"]: server for server in servers}
+        for server in servers:
+            self.update(server)
+
+    def update(self, server):
+        """Пересчитывает место сервера после изменения его счётчиков."""
+        host = server["host"]
+        self._servers[host] = server
+        if server["current_devices"] >= server["max_devices"]:
+            self._entries.pop(host, None)
+            return
+        score = self._score(server)
+        entry = self._entries.get(host)
+        if entry and entry[0] == score:
+            return
+        self._push(host, score)
+
+    def remove(self, host):
+        self._servers.pop(host, None)
+        self._entries.pop(host, None)
+
+    def has_free_slots(self):
+        return bool(self._entries)
+
+    def select(self, is_available=None):
+        """Возвращает лучший сервер, пропуская те, для которых is_available(host) ложно."""
+        skipped = []
+        selected = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            host = entry[2]
+            if self._entries.get(host) is not entry:
+                continue  # Устаревшая запись
+            if is_available and not is_available(host):
+                skipped.append(entry)
+                continue
+            selected = host
+            if self.strategy == ROUND_ROBIN:
+                # Выбранный сервер уходит в конец очереди
+                self._push(host, next(self._counter))
+            else:
+                heapq.heappush(self._heap, entry)
+            break
+
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+
+        return self._servers[selected] if selected else None
@@ -0,0 +1,61 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import NamedTuple, Optional
+from dotenv import load_dotenv
+from pony.orm import db_session, select, count, min as min_
+from cache import TTLCache
+from database import User, Subscription
+
+load_dotenv()
+
+
+class UserProfile(NamedTuple):
+    """Поля пользователя, которые показывают кнопки меню."""
+    dynamic_key: Optional[str]
+    subscription_end: Optional[datetime]
+    trial_end_date: Optional[datetime]
+    trial_used: bool
+    referral_code: Optional[str]
+    first_subscription_start: Optional[datetime]
+    invited_count: int
+
+
+# Сбрасывается при изменении пользователя: локально и по уведомлению из других процессов
+profile_cache = TTLCache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", "10000")),
+    ttl=int(os.getenv("PROFILE_CACHE_TTL", "300")),
+)
+
+
+@db_session
+def load_profile(telegram_id):
+    """Читает профиль из БД; None, если пользователя нет."""
+    user = User.get(telegram_id=telegram_id)
+    if user is None:
+        return None
+    return UserProfile(
+        dynamic_key=user.dynamic_key,
+        subscription_end=user.subscription_end,
+        trial_end_date=user.trial_end_date,
+        trial_used=user.trial_used,
+        referral_code=user.referral_code,
+        first_subscription_start=select(min_(s.start_date) for s in Subscription if s.user == user).first(),
+        invited_count=count(u for u in User if u.referred_by == user),
+    )
+
+
+async def get_profile(telegram_id):
+    """Профиль из кэша, при промахе - из БД (в пуле потоков). Отсутствующих пользователей не кэшируем."""
+    profile = profile_cache.get(telegram_id)
+    if profile is None:
+        # Инвалидация во время чтения не даст закэшировать устаревший профиль
+        generation = profile_cache.generation
+        profile = await asyncio.to_thread(load_profile, telegram_id)
+        if profile is not None:
+            profile_cache.set(telegram_id, profile, generation=generation)
+    return profile
+
+
+def invalidate_profile(telegram_id):
+    profile_cache.invalidate(telegram_id)
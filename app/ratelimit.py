@@ -0,0 +1,66 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds):
+        """Не выдаёт токены seconds секунд - например, пока Telegram просит подождать."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены, если они есть, не дожидаясь."""
+        if time.monotonic() < self.paused_until:
+            return False
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """Дожидается токенов; ожидающие обслуживаются по очереди."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                paused = self.paused_until - time.monotonic()
+                await asyncio.sleep(paused if paused > 0 else (tokens - self.tokens) / self.rate)
+
+
+class KeyedBuckets:
+    """Отдельное ведро на каждый ключ (чат, пользователь) с вытеснением давно не использованных."""
+
+    def __init__(self, rate, capacity=None, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,141 @@
+import csv
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", "500"))  # Пользователей на страницу отчёта
+EXPIRING_DAYS = 3  # По умолчанию для /database expiring
+
+USAGE_TEXT = (
+    "Использование:\n"
+    "/database [all|active|expiring [дней]] [server <host>] [page <n>] - отчёт CSV-файлом\n"
+    "/database <username> - данные одного пользователя"
+)
+
+HEADER = [
+    "telegram_id", "username", "host", "key_id", "access_key", "subscription_end", "trial_end_date",
+    "subscriptions", "payments_count", "payments_total", "payments",
+]
+
+
+class ReportFilter(NamedTuple):
+    """Какие пользователи попадают в отчёт. page=None - все страницы."""
+    status: str = "active"  # all / active / expiring
+    expiring_days: int = EXPIRING_DAYS
+    host: Optional[str] = None
+    page: Optional[int] = None
+
+
+def parse_filter(args):
+    """Разбирает аргументы /database. None - аргумент не фильтр, а имя пользователя.
+
+    ValueError - фильтр записан с ошибкой.
+    """
+    if args and args[0] not in ("all", "active", "expiring", "server", "page"):
+        return None
+
+    report_filter = ReportFilter()
+    args = list(args)
+    while args:
+        word = args.pop(0)
+        if word in ("all", "active"):
+            report_filter = report_filter._replace(status=word)
+        elif word == "expiring":
+            report_filter = report_filter._replace(status=word)
+            if args and args[0].isdigit():
+                report_filter = report_filter._replace(expiring_days=int(args.pop(0)))
+        elif word == "server" and args:
+            report_filter = report_filter._replace(host=args.pop(0))
+        elif word == "page" and args and args[0].isdigit() and int(args[0]) > 0:
+            report_filter = report_filter._replace(page=int(args.pop(0)))
+        else:
+            raise ValueError(word)
+    return report_filter
+
+
+def _format_date(value):
+    return value.strftime("%Y-%m-%d %H:%M") if value else ""
+
+
+def format_row(user, subscriptions, payments):
+    """Строка CSV из пользователя, его подписок и платежей (см. database.get_report_page)."""
+    telegram_id, username, host, key_id, access_key, subscription_end, trial_end_date = user
+    return [
+        telegram_id, username or "", host or "", key_id if key_id is not None else "", access_key or "",
+        _format_date(subscription_end), _format_date(trial_end_date),
+        "; ".join(
+            f"{amount}₽ {start:%d.%m.%Y} → {end:%d.%m.%Y} {status}" for amount, start, end, status in subscriptions
+        ),
+        len(payments),
+        sum(amount for amount, _, _ in payments),
+        "; ".join(f"{amount}₽ {date:%d.%m.%Y} {status}" for amount, date, status in payments),
+    ]
+
+
+def iter_rows(report_filter, fetch_page=None, find_cursor=None):
+    """Строки отчёта страница за страницей: в памяти не больше одной страницы пользователей.
+
+    Без номера страницы выгружаются все страницы подряд (по telegram_id, без OFFSET).
+    Для номера страницы начало находится запросом только по id, подписки и платежи
+    загружаются лишь для выгружаемой страницы.
+    """
+    if fetch_page is None:
+        # Разбор фильтров не должен требовать подключения к БД
+        from database import get_report_page as fetch_page, get_report_cursor as find_cursor
+
+    filters = (report_filter.status, report_filter.host, datetime.now() + timedelta(days=report_filter.expiring_days))
+    if report_filter.page is not None:
+        after_id = find_cursor(*filters, (report_filter.page - 1) * REPORT_PAGE_SIZE)
+        if after_id is not None:
+            for user, subscriptions, payments in fetch_page(*filters, after_id, REPORT_PAGE_SIZE):
+                yield format_row(user, subscriptions, payments)
+        return
+
+    after_id = 0
+    while True:
+        batch = fetch_page(*filters, after_id, REPORT_PAGE_SIZE)
+        for user, subscriptions, payments in batch:
+            yield format_row(user, subscriptions, payments)
+        if len(batch) < REPORT_PAGE_SIZE:
+            return
+        after_id = batch[-1][0][0]
+
+
+def write_csv(rows, file):
+    """Пишет заголовок и строки в файл по одной. Возвращает число строк."""
+    writer = csv.writer(file)
+    writer.writerow(HEADER)
+    written = 0
+    for row in rows:
+        writer.writerow(row)
+        written += 1
+    return written
+
+
+def build_report(report_filter, fetch_page=None, find_cursor=None):
+    """Собирает отчёт во временный CSV-файл. Возвращает (путь, число пользователей); файл удаляет вызывающий."""
+    # utf-8-sig - чтобы Excel правильно открыл кириллицу
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8-sig", delete=False) as file:
+        try:
+            written = write_csv(iter_rows(report_filter, fetch_page, find_cursor), file)
+        except Exception:
+            file.close()
+            os.remove(file.name)
+            raise
+    return file.name, written
+
+
+def report_filename(report_filter):
+    parts = ["users", report_filter.status]
+    if report_filter.status == "expiring":
+        parts.append(f"{report_filter.expiring_days}d")
+    if report_filter.host:
+        parts.append(report_filter.host)
+    if report_filter.page:
+        parts.append(f"page{report_filter.page}")
+    parts.append(datetime.now().strftime("%Y%m%d_%H%M"))
+    return "_".join(parts) + ".csv"
@@ -0,0 +1,70 @@
+import asyncio
+import os
+from collections import defaultdict
+from dotenv import load_dotenv
+from logger import logger
+from database import clear_user_keys
+from profiles import invalidate_profile
+from outline import get_client
+from servers import registry
+
+load_dotenv()
+
+CONCURRENCY_PER_SERVER = int(os.getenv("REVOKE_CONCURRENCY_PER_SERVER", "5"))  # Одновременных DELETE на сервер
+CHUNK_SIZE = 500  # Пользователей на одну пачку (и один UPDATE в БД)
+
+
+async def _delete_key(server, telegram_id, key_id, semaphore):
+    async with semaphore:
+        try:
+            status = await get_client(server["api_url"]).delete_access_key(key_id)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении ключа {key_id} пользователя {telegram_id}: {e}")
+            return False
+    # 404 - ключа на сервере уже нет, в БД его тоже можно очистить
+    return status in (204, 404)
+
+
+async def revoke_keys(users):
+    """Удаляет ключи пользователей на серверах Outline и очищает их в БД.
+
+    users - кортежи (telegram_id, key_id, host). Ключи удаляются параллельно,
+    но не больше CONCURRENCY_PER_SERVER запросов на один сервер. Возвращает
+    множество telegram_id, чьи ключи удалены.
+    """
+    semaphores = defaultdict(lambda: asyncio.Semaphore(CONCURRENCY_PER_SERVER))
+    servers = {server["host"]: server for server in await registry.get_servers()}
+    revoked = set()
+
+    for start in range(0, len(users), CHUNK_SIZE):
+        chunk = users[start:start + CHUNK_SIZE]
+        jobs, owners = [], []
+        for telegram_id, key_id, host in chunk:
+            server = servers.get(host)
+            if not server:
+                logger.error(f"Не найден сервер {host} для удаления ключа пользователя {telegram_id}")
+                continue
+            jobs.append(_delete_key(server, telegram_id, key_id, semaphores[host]))
+            owners.append((telegram_id, host))
+
+        results = await asyncio.gather(*jobs)
+
+        removed_per_host = defaultdict(int)
+        chunk_revoked = []
+        for (telegram_id, host), ok in zip(owners, results):
+            if ok:
+                chunk_revoked.append(telegram_id)
+                removed_per_host[host] += 1
+            else:
+                logger.warning(f"⚠ Ошибка удаления ключа пользователя {telegram_id}.")
+
+        if chunk_revoked:
+            await asyncio.to_thread(clear_user_keys, chunk_revoked)
+            for telegram_id in chunk_revoked:
+                invalidate_profile(telegram_id)
+            for host, removed in removed_per_host.items():
+                await registry.add_devices(host, -removed)
+            revoked.update(chunk_revoked)
+
+    logger.info(f"Удалено ключей: {len(revoked)} из {len(users)}")
+    return revoked
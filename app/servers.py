@@ -1,5 +1,11 @@
+import asyncio
 import json
+import os
+import tempfile
+import time
+from collections import defaultdict
 from logger import logger
+from placement import PlacementEngine, LEAST_UTILIZED
 import aiofiles
 
 HOSTS_FILE = "hosts.json"
@@ -19,43 +25,160 @@ async def load_servers_from_file(file_path):
         return []
 
 async def save_servers_to_file(file_path, servers):
-    """Асинхронно сохраняет серверы в файл."""
+    """Асинхронно и атомарно сохраняет серверы в файл (через временный файл).
+
+    Временный файл у каждой записи свой: бот и API могут сохранять одновременно.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(file_path)), prefix=f"{os.path.basename(file_path)}.", suffix=".tmp"
+    )
+    os.close(fd)
     try:
-        async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(servers, indent=4))
+        # mkstemp создаёт файл с правами 0600, оставляем права прежнего файла
+        os.chmod(tmp_path, os.stat(file_path).st_mode if os.path.exists(file_path) else 0o644)
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+            await f.write(json.dumps(servers, indent=4, ensure_ascii=False))
+        os.replace(tmp_path, file_path)
     except Exception as e:
         logger.error(f"Ошибка при сохранении серверов в файл {file_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-def get_available_server(servers):
-    """Возвращает доступный сервер"""
-    for server in servers:
-        if server['current_devices'] < server['max_devices']:
-            return server
-    return None
 
-async def has_free_slots(servers):
-    return any(server["current_devices"] < server["max_devices"] for server in servers)
+class ServerRegistry:
+    """Серверы из hosts.json в памяти.
 
+    Счётчики устройств меняются под asyncio-локом, а файл перезаписывается
+    отложенно: несколько изменений подряд дают одну запись. Если файл
+    поменяли снаружи (оператор или другой процесс), он перечитывается,
+    а ещё не записанные изменения накладываются поверх.
+    """
 
-async def add_device_to_host(host, change):
-    """Обновляет текущее количество подключенных устройств на сервере асинхронно."""
-    try:
-        async with aiofiles.open(HOSTS_FILE, "r", encoding="utf-8") as file:
-            contents = await file.read()
-            hosts = json.loads(contents)
+    def __init__(self, file_path, flush_delay=1.0, reload_interval=5.0, strategy=LEAST_UTILIZED):
+        self.file_path = file_path
+        self.placement = PlacementEngine(strategy)
+        self.flush_delay = flush_delay
+        self.reload_interval = reload_interval
+        self._servers = None
+        self._mtime = None
+        self._last_check = 0.0
+        self._deltas = defaultdict(int)  # Незаписанные изменения счётчиков
+        self._overrides = {}  # Незаписанные абсолютные значения счётчиков
+        self._lock = asyncio.Lock()
+        self._flush_task = None
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.file_path).st_mtime_ns
+        except OSError:
+            return None
+
+    async def _reload(self):
+        """Читает файл и накладывает незаписанные изменения."""
+        mtime = self._file_mtime()
+        servers = await load_servers_from_file(self.file_path)
+        for server in servers:
+            host = server["host"]
+            if host in self._overrides:
+                server["current_devices"] = self._overrides[host]
+            server["current_devices"] = max(0, server["current_devices"] + self._deltas.get(host, 0))
+        self._servers = servers
+        self._mtime = mtime
+        self.placement.rebuild(servers)
+
+    async def _ensure_loaded(self):
+        now = time.monotonic()
+        if self._servers is None:
+            await self._reload()
+            self._last_check = now
+        elif now - self._last_check >= self.reload_interval:
+            self._last_check = now
+            if self._file_mtime() != self._mtime:
+                logger.info(f"Файл {self.file_path} изменён, перечитываю серверы")
+                await self._reload()
+
+    def _find(self, host):
+        return next((s for s in self._servers if s["host"] == host), None)
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
 
-        for server in hosts:
-            if server["host"] == host:
-                server["current_devices"] = max(0, server["current_devices"] + change)
-                break
-        else:
-            return False  # Сервер не найден
+    async def get_servers(self):
+        """Возвращает копию списка серверов."""
+        async with self._lock:
+            await self._ensure_loaded()
+            return [dict(server) for server in self._servers]
 
-        async with aiofiles.open(HOSTS_FILE, "w", encoding="utf-8") as file:
-            await file.write(json.dumps(hosts, indent=4, ensure_ascii=False))
+    async def get_server(self, host):
+        """Возвращает копию сервера по имени хоста."""
+        async with self._lock:
+            await self._ensure_loaded()
+            server = self._find(host)
+            return dict(server) if server else None
 
-        return True
+    async def pick_server(self, is_available=None):
+        """Выбирает сервер для нового ключа по стратегии размещения."""
+        async with self._lock:
+            await self._ensure_loaded()
+            server = self.placement.select(is_available)
+            return dict(server) if server else None
 
+    async def has_free_slots(self):
+        async with self._lock:
+            await self._ensure_loaded()
+            return self.placement.has_free_slots()
+
+    async def add_devices(self, host, change):
+        """Изменяет число устройств на сервере на change."""
+        async with self._lock:
+            await self._ensure_loaded()
+            server = self._find(host)
+            if not server:
+                return False
+            server["current_devices"] = max(0, server["current_devices"] + change)
+            self._deltas[host] += change
+            self.placement.update(server)
+            self._schedule_flush()
+            return True
+
+    async def set_devices(self, server_usage):
+        """Устанавливает точное число устройств на серверах."""
+        async with self._lock:
+            await self._ensure_loaded()
+            for host, count in server_usage.items():
+                server = self._find(host)
+                if server:
+                    server["current_devices"] = count
+                    self._overrides[host] = count
+                    self._deltas.pop(host, None)
+                    self.placement.update(server)
+            self._schedule_flush()
+
+    async def flush(self):
+        """Записывает накопленные изменения в файл."""
+        async with self._lock:
+            if not self._deltas and not self._overrides:
+                return
+            # Не затираем чужие правки: сначала подтягиваем свежий файл
+            if self._file_mtime() != self._mtime:
+                await self._reload()
+            await save_servers_to_file(self.file_path, self._servers)
+            self._mtime = self._file_mtime()
+            self._deltas.clear()
+            self._overrides.clear()
+
+
+registry = ServerRegistry(HOSTS_FILE, strategy=os.getenv("PLACEMENT_STRATEGY", LEAST_UTILIZED))
+
+async def add_device_to_host(host, change):
+    """Обновляет текущее количество подключенных устройств на сервере асинхронно."""
+    try:
+        return await registry.add_devices(host, change)
     except Exception as e:
         logger.error(f"🚨 Ошибка обновления current_devices для {host}: {e}")
         return False
@@ -64,22 +187,10 @@ async def add_device_to_host(host, change):
 async def update_current_devices_in_hosts(server_usage):
     """Обновляет кол-во устройств на сервере"""
     try:
-        async with aiofiles.open("hosts.json", mode="r") as file:
-            content = await file.read()
-            hosts = json.loads(content)
-
-        # Обновляем количество подключенных пользователей для конкретного сервера
-        for server in hosts:
-            host_name = server["host"]
-            if host_name in server_usage:
-                server["current_devices"] = server_usage[host_name]
-
-        # Записываем обновленные данные в hosts.json
-        async with aiofiles.open("hosts.json", mode="w") as file:
-            await file.write(json.dumps(hosts, indent=4, ensure_ascii=False))
+        await registry.set_devices(server_usage)
 
         for host, count in server_usage.items():
             logger.info(f"✅ Изменено кол-во устройств на {host}: {count}")
 
     except Exception as e:
-        logger.error(f"❌ Ошибка при обновлении hosts.json: {e}")
\ No newline at end of file
+        logger.error(f"❌ Ошибка при обновлении hosts.json: {e}")
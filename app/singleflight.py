@@ -0,0 +1,72 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+ADVISORY_LOCK_TIMEOUT = "30s"  # Дольше ждать второй процесс не будем
+ADVISORY_LOCK_CONNECTIONS = 20  # Одновременно удерживаемых блокировок (и соединений) в процессе
+
+_lock_connections = asyncio.Semaphore(ADVISORY_LOCK_CONNECTIONS)
+
+
+class SingleFlight:
+    """Одновременные вызовы с одним ключом выполняются один раз и получают общий результат.
+
+    Вызов, который идёт дольше ttl секунд, считается зависшим: новые вызовы
+    его не ждут, а запускают свой.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._calls = {}  # ключ -> (время запуска, задача)
+
+    async def do(self, key, func, *args):
+        call = self._calls.get(key)
+        if call is None or time.monotonic() - call[0] > self.ttl:
+            task = asyncio.ensure_future(func(*args))
+            call = self._calls[key] = (time.monotonic(), task)
+            task.add_done_callback(lambda _: self._forget(key, task))
+        # shield: отмена одного из ожидающих не отменяет общий вызов
+        return await asyncio.shield(call[1])
+
+    def _forget(self, key, task):
+        call = self._calls.get(key)
+        if call is not None and call[1] is task:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+
+@asynccontextmanager
+async def advisory_lock(name):
+    """Блокировка Postgres между процессами (бот, API, воркеры вебхука).
+
+    Сессионная блокировка на отдельном соединении вне общего пула: пока её держат
+    (запросы к Outline), пул /conf не расходуется и транзакция не висит открытой.
+    Отдаёт это соединение (autocommit): через него можно перечитать данные,
+    не полагаясь на открытую у вызывающего сессию Pony. Закрытие соединения снимает
+    блокировку, в том числе при падении процесса.
+    """
+    from pg import connect  # SingleFlight не должен требовать подключения к БД
+
+    async with _lock_connections:
+        connection = await connect()
+        try:
+            await connection.execute(f"SET lock_timeout = '{ADVISORY_LOCK_TIMEOUT}'")
+            await connection.execute("SELECT pg_advisory_lock(hashtextextended($1, 0))", name)
+            yield connection
+        finally:
+            await connection.close()
+
+
+@asynccontextmanager
+async def try_advisory_lock(name):
+    """Как advisory_lock, но без ожидания: отдаёт False, если блокировку держит другой процесс."""
+    from pg import connect
+
+    async with _lock_connections:
+        connection = await connect()
+        try:
+            yield await connection.fetchval("SELECT pg_try_advisory_lock(hashtextextended($1, 0))", name)
+        finally:
+            await connection.close()
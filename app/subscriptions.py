@@ -0,0 +1,200 @@
+import asyncio
+from logger import logger
+from datetime import datetime, timedelta
+from pony.orm import db_session, commit, rollback, select, TransactionIntegrityError
+from database import User, Subscription, Payment, PendingPayment, notify_users_changed
+from keygen import generate_vpn_key, delete_vpn_key
+from payments import list_payments_since
+from profiles import invalidate_profile
+
+PAYMENT_TIMEOUT = timedelta(minutes=10)  # Сколько ждём оплату по ссылке
+
+
+async def activate_subscription(bot, user_id, payment_id, days, amount, payment_message=None) -> bool:
+    """Заносит успешный платеж в БД, продлевает подписку и выдаёт ключ.
+
+    Возвращает False, если платеж уже был обработан (вебхуком или опросом).
+    """
+    with db_session:
+        if Payment.exists(id=payment_id):
+            logger.info(f"Платеж {payment_id} уже обработан")
+            return False
+
+        user = User.get(telegram_id=user_id)
+        if not user:
+            logger.error(f"Не найден пользователь {user_id} для платежа {payment_id}")
+            return False
+
+        logger.info("Заносим данные в БД...")
+        # Получаем текущую активную подписку
+        active_subscription = Subscription.get(user=user, status="Active")
+
+        # Если подписка есть (активная или завершенная), продлеваем её
+        if active_subscription and active_subscription.end_date > datetime.now():
+            logger.info("Подписка активна, продлеваем её...")
+            active_subscription.end_date += timedelta(days=days)
+            user.subscription_end = active_subscription.end_date
+            is_new_subscription = False
+        elif active_subscription and active_subscription.end_date <= datetime.now():
+            logger.info("Продлеваем завершенную подписку")
+            active_subscription.end_date += timedelta(days=days)
+            user.subscription_end = active_subscription.end_date
+            is_new_subscription = False
+        else:
+            # Если подписки нет, создаём новую
+            logger.info("Создаю новую подписку")
+            now = datetime.now()
+            user.subscription_end = now + timedelta(days=days)
+            logger.info(f"Дата окончания подписки: {user.subscription_end}")
+            Subscription(
+                user=user,
+                start_date=now,
+                end_date=user.subscription_end,
+                amount=amount,
+                status="Active",
+            )
+            is_new_subscription = True
+
+        # Записываем платеж
+        Payment(
+            id=payment_id,
+            user=user,
+            amount=amount,
+            payment_date=datetime.now(),
+            status="succeeded"
+        )
+        user.last_payment_id = str(payment_id)
+
+        pending = PendingPayment.get(id=payment_id)
+        if pending:
+            pending.status = "succeeded"
+            payment_message = payment_message or pending.message_id
+
+        trial_key_id = None
+        if is_new_subscription and user.trial_end_date and user.trial_end_date > datetime.now():
+            user.trial_end_date = datetime.now()
+            trial_key_id = user.key_id
+
+        notify_users_changed([user_id])
+        try:
+            commit()
+        except TransactionIntegrityError:
+            # Параллельный обработчик успел записать этот платеж раньше нас
+            rollback()
+            logger.info(f"Платеж {payment_id} уже обработан")
+            return False
+        logger.info("Платеж был занесен в БД")
+        invalidate_profile(user_id)
+
+        has_key = bool(user.access_key)
+        formatted_date = user.subscription_end.strftime("%d %B %Y")
+
+    if payment_message:
+        try:
+            await bot.delete_message(user_id, payment_message)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить сообщение об оплате {payment_message}: {e}")
+
+    # Генерация нового ключа, если это новая подписка или ключ был удалён
+    if is_new_subscription:
+        logger.info("Генерируем новый VPN-ключ...")
+        if trial_key_id:
+            logger.info(f"Удаляем пробный ключ {trial_key_id}")
+            await delete_vpn_key(trial_key_id)
+
+        dynamic_key = await generate_vpn_key(user_id)
+        if dynamic_key:
+            with db_session:
+                user = User.get(telegram_id=user_id)
+                if user:
+                    user.trial_used = True
+                    notify_users_changed([user_id])
+            invalidate_profile(user_id)
+            logger.info("Сгенерировал новый ключ")
+            # Отправляем сообщение с ключом в формате кода
+            await bot.send_message(user_id, "✅ Оплата подтверждена! Тапните, чтобы скопировать Ваш VPN-ключ:")
+            await bot.send_message(user_id, text=f"`{dynamic_key}`", parse_mode="MarkdownV2")
+        else:
+            logger.error("Ошибка: generate_vpn_key() вернул None!")
+            await bot.send_message(user_id, "⚠️ Ошибка генерации VPN-ключа. Напишите в поддержку @vpnstalker.")
+    elif not has_key:
+        logger.info("Генерирую ключ после продления закончившейся подписки")
+        dynamic_key = await generate_vpn_key(user_id)
+        if dynamic_key:
+            await bot.send_message(user_id, "✅ Оплата подтверждена! Ваш VPN-ключ активен!")
+    else:
+        await bot.send_message(user_id, f"📅 Ваша подписка продлена! Теперь она активна до {formatted_date}\nПереходите в Outline и подключайтесь!")
+
+    return True
+
+
+@db_session
+def add_pending_payment(user_id, payment_id, amount, days, message_id):
+    """Сохраняет ожидающий оплаты платеж, чтобы его не потерять при перезапуске."""
+    PendingPayment(
+        id=payment_id,
+        user=User[user_id],
+        amount=amount,
+        days=days,
+        message_id=message_id,
+    )
+
+
+@db_session
+def set_pending_status(payment_ids, status):
+    """Проставляет статус ожидающим платежам."""
+    for pending in PendingPayment.select(lambda p: p.id in payment_ids):
+        pending.status = status
+
+
+@db_session
+def get_open_pending_payments():
+    """Ожидающие оплаты платежи: (id, telegram_id, сумма, дни, id сообщения, создан)."""
+    return select(
+        (p.id, p.user.telegram_id, p.amount, p.days, p.message_id, p.created_at)
+        for p in PendingPayment if p.status == "pending"
+    )[:]
+
+
+async def reconcile_pending_payments(bot):
+    """Сверяет все открытые платежи с ЮKassa одним постраничным запросом."""
+    pending = await asyncio.to_thread(get_open_pending_payments)
+    if not pending:
+        return
+
+    since = min(created_at for *_, created_at in pending)
+    payments = await list_payments_since(since)
+    if payments is None:
+        return
+
+    now = datetime.now()
+    canceled, expired = [], []
+    for payment_id, user_id, amount, days, message_id, created_at in pending:
+        payment = payments.get(payment_id)
+        status = payment.status if payment else None
+
+        if status == "succeeded":
+            # Ошибка одного платежа (например, бот заблокирован после commit) не должна останавливать сверку
+            try:
+                # Статус pending закроет сама активация, если вебхук не успел раньше
+                await activate_subscription(bot, user_id, payment_id, days, amount, message_id)
+                await asyncio.to_thread(set_pending_status, [payment_id], "succeeded")
+            except Exception as e:
+                logger.error(f"Ошибка активации платежа {payment_id} при сверке: {e}", exc_info=True)
+        elif status == "canceled":
+            logger.info(f"Платеж {payment_id} отменен")
+            canceled.append(payment_id)
+        elif now - created_at > PAYMENT_TIMEOUT:
+            expired.append((payment_id, user_id))
+
+    if canceled:
+        await asyncio.to_thread(set_pending_status, canceled, "canceled")
+    if expired:
+        # Статус сохраняем до уведомлений, чтобы следующая сверка не повторила сообщение
+        await asyncio.to_thread(set_pending_status, [payment_id for payment_id, _ in expired], "expired")
+        logger.info(f"Истекло ожидающих платежей: {len(expired)}")
+        for payment_id, user_id in expired:
+            try:
+                await bot.send_message(user_id, "⏳ Время на оплату истекло. Попробуйте снова.")
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить {user_id} об истечении платежа: {e}")
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+
+
+def notification(payment_id):
+    return {
+        "type": "notification",
+        "event": "payment.succeeded",
+        "object": {
+            "id": payment_id,
+            "status": "succeeded",
+            "amount": {"value": "199.00", "currency": "RUB"},
+            "paid": True,
+            "refundable": True,
+            "created_at": "2026-01-01T00:00:00.000Z",
+            "test": True,
+            "metadata": {"user_id": "42", "days": "30"},
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+        },
+    }
+
+
+def yookassa_payment(status):
+    return SimpleNamespace(
+        status=status, metadata={"user_id": "42", "days": "30"}, amount=SimpleNamespace(value="199.00")
+    )
+
+
+@pytest.fixture
+def activate(monkeypatch):
+    monkeypatch.setattr(api, "YOOKASSA_CHECK_IP", False)
+    activate = AsyncMock(return_value=True)
+    monkeypatch.setattr(api, "activate_subscription", activate)
+    return activate
+
+
+def test_webhook_activates_subscription_from_api_payment(monkeypatch, activate):
+    get_payment = AsyncMock(return_value=yookassa_payment("succeeded"))
+    monkeypatch.setattr(api, "get_payment", get_payment)
+
+    response = TestClient(api.app).post("/yookassa/webhook", json=notification("pay-1"))
+
+    assert response.status_code == 200
+    get_payment.assert_awaited_once_with("pay-1")
+    activate.assert_awaited_once_with(api.bot, 42, "pay-1", 30, 199.0)
+
+
+def test_webhook_trusts_api_status_not_notification_body(monkeypatch, activate):
+    monkeypatch.setattr(api, "get_payment", AsyncMock(return_value=yookassa_payment("pending")))
+
+    response = TestClient(api.app).post("/yookassa/webhook", json=notification("pay-2"))
+
+    assert response.status_code == 200
+    activate.assert_not_awaited()
+
+
+def test_webhook_rejects_untrusted_ip(monkeypatch, activate):
+    monkeypatch.setattr(api, "YOOKASSA_CHECK_IP", True)
+
+    response = TestClient(api.app).post(
+        "/yookassa/webhook", json=notification("pay-3"), headers={"X-Real-IP": "203.0.113.1"}
+    )
+
+    assert response.status_code == 403
+    activate.assert_not_awaited()
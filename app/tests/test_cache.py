@@ -0,0 +1,56 @@
+import time
+
+from cache import TTLCache
+
+
+def test_entries_expire_after_ttl():
+    cache = TTLCache(ttl=0.05)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+
+
+def test_per_entry_ttl_overrides_default():
+    cache = TTLCache(ttl=60)
+    cache.set("a", 1, ttl=0)
+
+    assert cache.get("a") is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+
+def test_pop_invalidates_entry():
+    cache = TTLCache()
+    cache.set("a", 1)
+
+    assert cache.pop("a") == 1
+    assert cache.get("a") is None
+    assert cache.pop("a") is None
+
+
+def test_load_started_before_invalidation_is_not_cached():
+    cache = TTLCache(maxsize=1)
+    generation = cache.generation
+    cache.invalidate("a")
+
+    assert not cache.set("a", "old", generation=generation)
+    assert cache.get("a") is None
+    assert cache.set("a", "new", generation=cache.generation)
+
+    # Вытесненная инвалидация всё равно учитывается
+    generation = cache.generation
+    cache.invalidate("b")
+    cache.invalidate("c")
+    assert not cache.set("b", "old", generation=generation)
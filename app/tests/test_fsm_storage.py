@@ -0,0 +1,63 @@
+import pytest
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from pony.orm import db_session
+
+from database import FsmRecord
+from fsm_storage import PonyStorage, create_storage
+
+KEY = StorageKey(bot_id=1, chat_id=9101, user_id=9101)
+
+
+class Form(StatesGroup):
+    email = State()
+
+
+@pytest.fixture
+def storage():
+    storage = PonyStorage()
+    record_key = storage.key_builder.build(KEY)
+    yield storage
+    with db_session:
+        FsmRecord.select(lambda r: r.key == record_key).delete(bulk=True)
+
+
+def stored_record(storage):
+    with db_session:
+        record = FsmRecord.get(key=storage.key_builder.build(KEY))
+        return record and (record.state, record.data)
+
+
+@pytest.mark.asyncio
+async def test_state_and_data_round_trip(storage):
+    assert await storage.get_state(KEY) is None
+    assert await storage.get_data(KEY) == {}
+
+    await storage.set_state(KEY, Form.email)
+    await storage.set_data(KEY, {"plan": 30})
+
+    assert await storage.get_state(KEY) == Form.email.state
+    assert await storage.get_data(KEY) == {"plan": 30}
+    # Новая запись данных не стирает состояние
+    assert stored_record(storage) == (Form.email.state, {"plan": 30})
+
+
+@pytest.mark.asyncio
+async def test_empty_record_is_deleted(storage):
+    await storage.set_state(KEY, "Form:email")
+    await storage.set_data(KEY, {"plan": 30})
+
+    await storage.set_state(KEY, None)
+    assert stored_record(storage) == (None, {"plan": 30})
+
+    await storage.set_data(KEY, {})
+    assert stored_record(storage) is None
+    assert await storage.get_state(KEY) is None
+
+
+def test_create_storage():
+    assert isinstance(create_storage("memory"), MemoryStorage)
+    assert isinstance(create_storage("pony"), PonyStorage)
+    with pytest.raises(ValueError):
+        create_storage("sqlite")
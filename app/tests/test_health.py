@@ -0,0 +1,34 @@
+import pytest
+from unittest.mock import AsyncMock, patch
+
+from health import CircuitBreaker, HealthProber
+
+
+def test_breaker_opens_after_threshold_and_closes_on_success():
+    breaker = CircuitBreaker(failure_threshold=2)
+
+    breaker.record_failure("timeout")
+    assert not breaker.is_open
+    breaker.record_failure("timeout")
+    assert breaker.is_open
+
+    breaker.record_success(latency=0.1)
+    assert not breaker.is_open
+    assert breaker.latency == 0.1
+
+
+@pytest.mark.asyncio
+async def test_failed_probe_excludes_server():
+    prober = HealthProber()
+    server = {"host": "a", "api_url": "https://a"}
+    client = AsyncMock()
+    client.get_server_info.side_effect = ConnectionError("down")
+
+    with patch("health.get_client", return_value=client):
+        for _ in range(prober.breaker("a").failure_threshold):
+            await prober.probe(server)
+        assert not prober.is_available("a")
+
+        client.get_server_info.side_effect = None
+        await prober.probe(server)
+        assert prober.is_available("a")
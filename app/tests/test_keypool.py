@@ -0,0 +1,124 @@
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock
+
+import pytest
+
+import keypool
+from keypool import KeyPool, POOL_KEY_NAME
+
+SERVERS = [{"host": "a", "api_url": "a"}, {"host": "b", "api_url": "b"}, {"host": "down", "api_url": "down"}]
+
+
+def access_key(key_id, name=POOL_KEY_NAME):
+    return {"id": str(key_id), "name": name, "port": 443, "password": "p", "method": "m", "accessUrl": f"ss://{key_id}"}
+
+
+class FakeOutline:
+    def __init__(self, keys=()):
+        self.keys = list(keys)
+        self.created = 0
+        self.renamed = []
+
+    async def list_access_keys(self):
+        return self.keys
+
+    async def create_access_key(self, name):
+        self.created += 1
+        return access_key(100 + self.created, name)
+
+    async def rename_access_key(self, key_id, name):
+        self.renamed.append((key_id, name))
+
+
+class FakeRegistry:
+    async def get_servers(self):
+        return SERVERS
+
+
+class FakeProber:
+    def is_available(self, host):
+        return host != "down"
+
+    def record_failure(self, host, reason=None):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    clients = {server["host"]: FakeOutline() for server in SERVERS}
+    pooled = []
+    monkeypatch.setattr(keypool, "get_client", lambda api_url: clients[api_url])
+    monkeypatch.setattr(keypool, "registry", FakeRegistry())
+    monkeypatch.setattr(keypool, "prober", FakeProber())
+    monkeypatch.setattr(keypool, "get_pool_sizes", lambda: {"a": 1})
+    monkeypatch.setattr(keypool, "add_pooled_key", lambda host, data: pooled.append((host, int(data["id"]))))
+    monkeypatch.setattr(keypool, "get_unassigned_keys", lambda host, key_ids: set(key_ids) - {7})
+    lock = {"acquired": True}
+
+    @asynccontextmanager
+    async def try_advisory_lock(name):
+        yield lock["acquired"]
+
+    monkeypatch.setattr(keypool, "try_advisory_lock", try_advisory_lock)
+    pool = KeyPool(size=3)
+    pool.clients, pool.pooled, pool.lock = clients, pooled, lock
+    return pool
+
+
+@pytest.mark.asyncio
+async def test_claim_disabled_pool(pool, monkeypatch):
+    claim = AsyncMock()
+    monkeypatch.setattr(keypool, "claim_pooled_key", claim)
+    assert await KeyPool(size=0).claim(SERVERS[0], 42) is None
+    claim.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_claim_empty_pool(pool, monkeypatch):
+    monkeypatch.setattr(keypool, "claim_pooled_key", lambda host: None)
+    assert await pool.claim(SERVERS[0], 42) is None
+
+
+@pytest.mark.asyncio
+async def test_claim_renames_key_and_refills(pool, monkeypatch):
+    data = {"key_id": 5, "access_key": "ss://5", "server_port": "443", "password": "p", "method": "m"}
+    monkeypatch.setattr(keypool, "claim_pooled_key", lambda host: data)
+    monkeypatch.setattr(pool, "refill", AsyncMock())
+
+    assert await pool.claim(SERVERS[0], 42) == data
+    await pool.stop()
+
+    assert pool.clients["a"].renamed == [(5, "42")]
+    pool.refill.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_refill_tops_up_available_servers(pool):
+    await pool.refill()
+
+    assert pool.clients["a"].created == 2
+    assert pool.clients["b"].created == 3
+    assert pool.clients["down"].created == 0
+    assert sorted(pool.pooled) == [("a", 101), ("a", 102), ("b", 101), ("b", 102), ("b", 103)]
+
+
+@pytest.mark.asyncio
+async def test_refill_skipped_while_other_process_refills(pool):
+    pool.lock["acquired"] = False
+    await pool.refill()
+    assert pool.clients["a"].created == pool.clients["b"].created == 0
+
+
+@pytest.mark.asyncio
+async def test_orphaned_keys_return_to_pool_after_grace(pool, monkeypatch):
+    monkeypatch.setattr(pool, "_fill", AsyncMock())
+    # 5 - упал процесс до записи в пул, 7 - уже выдан пользователю, 8 - ключ пользователя
+    pool.clients["a"].keys = [access_key(5), access_key(7), access_key(8, "42")]
+
+    await pool.refill(reconcile=True)
+    assert pool.pooled == []  # Мог быть только что выдан из пула
+
+    monkeypatch.setattr(keypool, "ORPHAN_GRACE", 0)
+    await pool.refill(reconcile=True)
+    assert pool.pooled == [("a", 5)]
+    assert pool._orphans["a"] == {}
@@ -0,0 +1,51 @@
+import json
+
+import logger as logger_module
+from logger import setup_logger, stop_logger
+
+
+def test_records_are_written_by_listener_thread(tmp_path):
+    path = tmp_path / "test.log"
+    log = setup_logger("test_queued_logger", str(path), console=False)
+    log.info("пользователь %s", 42)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.exception("ошибка")
+    stop_logger("test_queued_logger")
+
+    text = path.read_text(encoding="utf-8")
+    assert "INFO - пользователь 42" in text
+    assert "ValueError: boom" in text
+
+
+def test_json_format_keeps_exception_separately(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger_module, "LOG_FORMAT", "json")
+    path = tmp_path / "test.json.log"
+    log = setup_logger("test_json_logger", str(path), console=False)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.error("ошибка %s", "оплаты", exc_info=True)
+    stop_logger("test_json_logger")
+
+    entry = json.loads(path.read_text(encoding="utf-8"))
+    assert entry["message"] == "ошибка оплаты"
+    assert entry["level"] == "ERROR"
+    assert "ValueError: boom" in entry["exception"]
+
+
+
+def test_file_is_reopened_after_external_rotation(tmp_path):
+    path = tmp_path / "rotated.log"
+    log = setup_logger("test_rotated_logger", str(path), console=False)
+    listener = logger_module._listeners["test_rotated_logger"]
+    log.info("до ротации")
+    listener.stop()  # Дописываем очередь, чтобы переименовать файл после записи
+    path.rename(tmp_path / "rotated.log.1")
+    listener.start()
+    log.info("после ротации")
+    stop_logger("test_rotated_logger")
+
+    assert "до ротации" in (tmp_path / "rotated.log.1").read_text(encoding="utf-8")
+    assert "после ротации" in path.read_text(encoding="utf-8")
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types.input_file import FSInputFile
+
+from media import MediaCache
+
+
+def photo_message(file_id):
+    return SimpleNamespace(photo=[SimpleNamespace(file_id="thumb"), SimpleNamespace(file_id=file_id)])
+
+
+def test_file_id_is_reused_after_first_upload(tmp_path):
+    image = tmp_path / "guide.jpg"
+    image.write_bytes(b"jpeg")
+    cache = MediaCache(str(tmp_path / "media.json"))
+
+    assert isinstance(cache.get(str(image)), FSInputFile)
+    cache.remember(str(image), photo_message("AgAD-guide"))
+
+    assert cache.get(str(image)) == "AgAD-guide"
+    assert MediaCache(str(tmp_path / "media.json")).get(str(image)) == "AgAD-guide"
+
+
+def test_changed_file_is_uploaded_again(tmp_path):
+    image = tmp_path / "guide.jpg"
+    image.write_bytes(b"jpeg")
+    cache = MediaCache(str(tmp_path / "media.json"))
+    cache.remember(str(image), photo_message("AgAD-old"))
+
+    image.write_bytes(b"new jpeg")
+
+    assert isinstance(cache.get(str(image)), FSInputFile)
+
+
+@pytest.mark.asyncio
+async def test_only_file_id_errors_trigger_reupload(tmp_path):
+    image = tmp_path / "guide.jpg"
+    image.write_bytes(b"jpeg")
+    cache = MediaCache(str(tmp_path / "media.json"))
+    cache.remember(str(image), photo_message("AgAD-guide"))
+
+    async def not_modified(media):
+        raise TelegramBadRequest(method=None, message="Bad Request: message is not modified")
+
+    with pytest.raises(TelegramBadRequest):
+        await cache._send(str(image), not_modified)
+    assert cache.get(str(image)) == "AgAD-guide"
+
+    sent = []
+
+    async def send(media):
+        sent.append(media)
+        if isinstance(media, str):
+            raise TelegramBadRequest(method=None, message="Bad Request: wrong file identifier/HTTP URL specified")
+        return photo_message("AgAD-new")
+
+    await cache._send(str(image), send)
+    assert isinstance(sent[-1], FSInputFile)
+    assert cache.get(str(image)) == "AgAD-new"
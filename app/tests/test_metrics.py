@@ -0,0 +1,38 @@
+import metrics
+from metrics import Histogram, _format_labels, render, snapshot_path
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_latency_seconds", "test", ["handler"], buckets=(0.1, 1))
+    histogram.observe(0.05, handler="start")
+    histogram.observe(0.5, handler="start")
+    histogram.observe(5, handler="start")
+
+    samples = {(name, labels.get("le")): value for name, labels, value in histogram.samples()}
+    assert samples[("test_latency_seconds_bucket", "0.1")] == 1
+    assert samples[("test_latency_seconds_bucket", "1")] == 2
+    assert samples[("test_latency_seconds_bucket", "+Inf")] == 3
+    assert samples[("test_latency_seconds_count", None)] == 3
+
+
+def test_snapshot_of_other_process_is_merged_into_one_family():
+    histogram = Histogram("test_merge_seconds", "test")
+    histogram.observe(0.2)
+    bot_samples = {"test_merge_seconds": [["test_merge_seconds_count", {}, 7]]}
+
+    text = render("api", {"bot": bot_samples})
+
+    assert text.count("# TYPE test_merge_seconds histogram") == 1
+    assert 'test_merge_seconds_count{process="api"} 1' in text
+    assert 'test_merge_seconds_count{process="bot"} 7' in text
+
+
+def test_label_values_are_escaped():
+    assert _format_labels({"server": 'a"b\\c'}) == '{server="a\\"b\\\\c"}'
+
+
+def test_primary_worker_shares_the_bot_snapshot(monkeypatch):
+    monkeypatch.setattr(metrics, "SNAPSHOT_FILE", "bot_metrics.json")
+
+    assert snapshot_path() == snapshot_path(0) == "bot_metrics.json"
+    assert snapshot_path(2) == "bot_metrics.2.json"
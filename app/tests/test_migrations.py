@@ -0,0 +1,28 @@
+from migrations import MIGRATIONS, pending_migrations, find_seq_scans
+
+
+def test_only_unapplied_migrations_are_pending():
+    migrations = [(2, "b", []), (1, "a", []), (3, "c", [])]
+
+    assert [m[0] for m in pending_migrations([1], migrations)] == [2, 3]
+    assert pending_migrations([1, 2, 3], migrations) == []
+
+
+def test_migration_versions_are_unique():
+    versions = [version for version, _, _ in MIGRATIONS]
+
+    assert len(versions) == len(set(versions))
+
+
+def test_seq_scans_are_found_in_nested_plan():
+    plan = {
+        "Node Type": "Hash Join",
+        "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "payment", "Plan Rows": 1200},
+            {"Node Type": "Hash", "Plans": [
+                {"Node Type": "Index Scan", "Relation Name": "user", "Plan Rows": 1},
+            ]},
+        ],
+    }
+
+    assert find_seq_scans(plan) == [("payment", 1200)]
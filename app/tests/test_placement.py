@@ -0,0 +1,63 @@
+import pytest
+
+from placement import PlacementEngine, LEAST_UTILIZED, WEIGHTED, ROUND_ROBIN
+
+
+def make_servers():
+    return [
+        {"host": "a", "max_devices": 100, "current_devices": 50, "bandwidth": 1000},
+        {"host": "b", "max_devices": 200, "current_devices": 60, "bandwidth": 100},
+        {"host": "c", "max_devices": 10, "current_devices": 10, "bandwidth": 1000},
+    ]
+
+
+def test_least_utilized_picks_lowest_ratio():
+    engine = PlacementEngine(LEAST_UTILIZED)
+    servers = make_servers()
+    engine.rebuild(servers)
+
+    assert engine.select()["host"] == "b"
+
+    servers[1]["current_devices"] = 190
+    engine.update(servers[1])
+    assert engine.select()["host"] == "a"
+
+
+def test_weighted_uses_declared_bandwidth():
+    engine = PlacementEngine(WEIGHTED)
+    engine.rebuild(make_servers())
+
+    assert engine.select()["host"] == "a"
+
+
+def test_round_robin_cycles_over_free_servers():
+    engine = PlacementEngine(ROUND_ROBIN)
+    engine.rebuild(make_servers())
+
+    assert [engine.select()["host"] for _ in range(4)] == ["a", "b", "a", "b"]
+
+
+def test_full_servers_are_never_selected():
+    engine = PlacementEngine(LEAST_UTILIZED)
+    servers = make_servers()
+    engine.rebuild(servers)
+
+    for server in servers:
+        server["current_devices"] = server["max_devices"]
+        engine.update(server)
+
+    assert not engine.has_free_slots()
+    assert engine.select() is None
+
+
+def test_unavailable_servers_are_skipped_but_kept():
+    engine = PlacementEngine(LEAST_UTILIZED)
+    engine.rebuild(make_servers())
+
+    assert engine.select(lambda host: host != "b")["host"] == "a"
+    assert engine.select()["host"] == "b"
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        PlacementEngine("random")
@@ -0,0 +1,61 @@
+import pytest
+
+import profiles
+from cache import TTLCache
+from profiles import UserProfile, get_profile, invalidate_profile
+
+PROFILE = UserProfile(None, None, None, False, "ref", None, 0)
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    monkeypatch.setattr(profiles, "profile_cache", TTLCache(maxsize=10, ttl=60))
+    loads = []
+
+    def load_profile(telegram_id):
+        loads.append(telegram_id)
+        return PROFILE if telegram_id == 1 else None
+
+    monkeypatch.setattr(profiles, "load_profile", load_profile)
+    return loads
+
+
+@pytest.mark.asyncio
+async def test_profile_is_read_through(loads):
+    assert await get_profile(1) == PROFILE
+    assert await get_profile(1) == PROFILE
+    assert loads == [1]
+
+
+@pytest.mark.asyncio
+async def test_invalidate_reloads_profile(loads):
+    await get_profile(1)
+    invalidate_profile(1)
+    await get_profile(1)
+    assert loads == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_missing_user_is_not_cached(loads):
+    assert await get_profile(2) is None
+    assert await get_profile(2) is None
+    assert loads == [2, 2]
+
+
+@pytest.mark.asyncio
+async def test_invalidation_during_load_keeps_stale_profile_out(loads, monkeypatch):
+    def load_profile(telegram_id):
+        loads.append(telegram_id)
+        # Пользователь изменился, пока профиль читался из БД
+        invalidate_profile(telegram_id)
+        return PROFILE
+
+    monkeypatch.setattr(profiles, "load_profile", load_profile)
+    assert await get_profile(1) == PROFILE
+    assert profiles.profile_cache.get(1) is None
+    await get_profile(1)
+    assert loads == [1, 1]
+
+
+def test_load_profile_missing_user():
+    assert profiles.load_profile(-1) is None
@@ -0,0 +1,47 @@
+import pytest
+import time
+
+from ratelimit import TokenBucket, KeyedBuckets
+
+
+def test_try_acquire_respects_capacity():
+    bucket = TokenBucket(rate=1, capacity=2)
+
+    assert bucket.try_acquire()
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_refill():
+    bucket = TokenBucket(rate=20, capacity=1)
+
+    started = time.monotonic()
+    for _ in range(3):
+        await bucket.acquire()
+
+    # Первый токен есть сразу, ещё два приходят по 1/20 секунды
+    assert time.monotonic() - started >= 0.09
+
+
+def test_keyed_buckets_evict_least_recently_used():
+    buckets = KeyedBuckets(rate=1, max_keys=2)
+
+    first = buckets.get("a")
+    buckets.get("b")
+    buckets.get("a")
+    buckets.get("c")
+
+    assert len(buckets) == 2
+    assert buckets.get("a") is first
+
+
+@pytest.mark.asyncio
+async def test_pause_blocks_all_waiters():
+    bucket = TokenBucket(rate=100)
+    bucket.pause(0.1)
+
+    assert not bucket.try_acquire()
+    started = time.monotonic()
+    await bucket.acquire()
+    assert time.monotonic() - started >= 0.09
@@ -0,0 +1,73 @@
+import csv
+import io
+from datetime import datetime
+
+import pytest
+
+import reports
+from reports import ReportFilter, parse_filter, iter_rows, write_csv, HEADER
+
+
+def test_parse_filter():
+    assert parse_filter([]) == ReportFilter()
+    assert parse_filter(["expiring", "7", "server", "1.2.3.4", "page", "2"]) == ReportFilter(
+        status="expiring", expiring_days=7, host="1.2.3.4", page=2
+    )
+    assert parse_filter(["all"]).status == "all"
+    assert parse_filter(["ivan"]) is None
+    with pytest.raises(ValueError):
+        parse_filter(["page", "0"])
+    with pytest.raises(ValueError):
+        parse_filter(["server"])
+
+
+def make_fetch(total, calls):
+    def fetch_page(status, host, expiring_until, after_id, limit):
+        calls.append(after_id)
+        ids = [i for i in range(1, total + 1) if i > after_id][:limit]
+        return [
+            (
+                (i, f"user{i}", "host", i, "ss://key", datetime(2026, 1, 1), None),
+                [(100.0, datetime(2025, 12, 1), datetime(2026, 1, 1), "Active")],
+                [(100.0, datetime(2025, 12, 1), "succeeded"), (50.0, datetime(2025, 11, 1), "succeeded")],
+            )
+            for i in ids
+        ]
+    return fetch_page
+
+
+def test_all_pages_are_streamed_by_keyset(monkeypatch):
+    monkeypatch.setattr(reports, "REPORT_PAGE_SIZE", 2)
+    calls = []
+    rows = list(iter_rows(ReportFilter(status="all"), make_fetch(5, calls)))
+
+    assert [row[0] for row in rows] == [1, 2, 3, 4, 5]
+    assert calls == [0, 2, 4]
+    assert rows[0][8:10] == [2, 150.0]
+
+
+def test_single_page_skips_to_cursor_by_ids(monkeypatch):
+    monkeypatch.setattr(reports, "REPORT_PAGE_SIZE", 2)
+    calls, offsets = [], []
+
+    def find_cursor(status, host, expiring_until, offset):
+        offsets.append(offset)
+        return offset if offset < 5 else None
+
+    rows = list(iter_rows(ReportFilter(page=2), make_fetch(5, calls), find_cursor))
+    assert [row[0] for row in rows] == [3, 4]
+    assert offsets == [2]
+    assert calls == [2]
+
+    assert list(iter_rows(ReportFilter(page=4), make_fetch(5, calls), find_cursor)) == []
+    assert calls == [2]
+
+
+def test_write_csv():
+    file = io.StringIO()
+    assert write_csv(iter_rows(ReportFilter(), make_fetch(3, [])), file) == 3
+
+    lines = list(csv.reader(io.StringIO(file.getvalue())))
+    assert lines[0] == HEADER
+    assert lines[1][:2] == ["1", "user1"]
+    assert lines[1][7] == "100.0₽ 01.12.2025 → 01.01.2026 Active"
@@ -0,0 +1,89 @@
+import asyncio
+from collections import defaultdict
+
+import pytest
+
+import revocation
+from revocation import revoke_keys
+
+SERVERS = [{"host": "a", "api_url": "a"}, {"host": "b", "api_url": "b"}]
+
+
+class FakeOutline:
+    def __init__(self, statuses):
+        self.statuses = statuses  # key_id -> статус ответа или исключение
+        self.in_flight = self.max_in_flight = 0
+        self.deleted = []
+
+    async def delete_access_key(self, key_id):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            status = self.statuses.get(key_id, 204)
+            if isinstance(status, Exception):
+                raise status
+            self.deleted.append(key_id)
+            return status
+        finally:
+            self.in_flight -= 1
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.devices = defaultdict(int)
+
+    async def get_servers(self):
+        return SERVERS
+
+    async def add_devices(self, host, delta):
+        self.devices[host] += delta
+
+
+@pytest.fixture
+def outline(monkeypatch):
+    clients = {"a": FakeOutline({}), "b": FakeOutline({})}
+    registry = FakeRegistry()
+    cleared, invalidated = [], []
+    monkeypatch.setattr(revocation, "get_client", lambda api_url: clients[api_url])
+    monkeypatch.setattr(revocation, "registry", registry)
+    monkeypatch.setattr(revocation, "clear_user_keys", lambda telegram_ids: cleared.append(sorted(telegram_ids)))
+    monkeypatch.setattr(revocation, "invalidate_profile", invalidated.append)
+    return clients, registry, cleared, invalidated
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_limited_per_server(outline, monkeypatch):
+    clients, registry, cleared, _ = outline
+    monkeypatch.setattr(revocation, "CONCURRENCY_PER_SERVER", 2)
+    users = [(i, i, "a" if i % 2 else "b") for i in range(10)]
+
+    assert await revoke_keys(users) == set(range(10))
+    assert clients["a"].max_in_flight == clients["b"].max_in_flight == 2
+    assert registry.devices == {"a": -5, "b": -5}
+
+
+@pytest.mark.asyncio
+async def test_users_are_cleared_in_chunks(outline, monkeypatch):
+    _, registry, cleared, invalidated = outline
+    monkeypatch.setattr(revocation, "CHUNK_SIZE", 2)
+
+    await revoke_keys([(1, 11, "a"), (2, 12, "a"), (3, 13, "b"), (4, 14, "b"), (5, 15, "a")])
+
+    assert cleared == [[1, 2], [3, 4], [5]]
+    assert sorted(invalidated) == [1, 2, 3, 4, 5]
+    assert registry.devices == {"a": -3, "b": -2}
+
+
+@pytest.mark.asyncio
+async def test_only_deleted_keys_are_cleared(outline):
+    clients, registry, cleared, invalidated = outline
+    clients["a"].statuses = {11: 500, 12: 404, 13: ConnectionError("reset")}
+
+    revoked = await revoke_keys([(1, 11, "a"), (2, 12, "a"), (3, 13, "a"), (4, 14, "b"), (5, 15, "unknown")])
+
+    # 404 - ключа на сервере уже нет, он тоже считается удалённым
+    assert revoked == {2, 4}
+    assert cleared == [[2, 4]]
+    assert sorted(invalidated) == [2, 4]
+    assert registry.devices == {"a": -1, "b": -1}
@@ -0,0 +1,87 @@
+import pytest
+import asyncio
+import json
+
+from servers import ServerRegistry, save_servers_to_file
+
+
+def write_hosts(path, servers):
+    path.write_text(json.dumps(servers), encoding="utf-8")
+
+
+def read_hosts(path):
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+@pytest.fixture
+def hosts_file(tmp_path):
+    path = tmp_path / "hosts.json"
+    write_hosts(path, [
+        {"host": "a", "api_url": "https://a", "max_devices": 10, "current_devices": 0},
+        {"host": "b", "api_url": "https://b", "max_devices": 10, "current_devices": 5},
+    ])
+    return path
+
+
+@pytest.mark.asyncio
+async def test_concurrent_increments_are_not_lost(hosts_file):
+    registry = ServerRegistry(str(hosts_file), flush_delay=0.05)
+
+    await asyncio.gather(*(registry.add_devices("a", +1) for _ in range(50)))
+    await registry.flush()
+
+    assert (await registry.get_server("a"))["current_devices"] == 50
+    assert read_hosts(hosts_file)[0]["current_devices"] == 50
+
+
+@pytest.mark.asyncio
+async def test_writes_are_coalesced(hosts_file):
+    registry = ServerRegistry(str(hosts_file), flush_delay=0.05)
+
+    await registry.add_devices("a", +1)
+    await registry.add_devices("b", -1)
+    # До истечения задержки файл не тронут
+    assert read_hosts(hosts_file)[0]["current_devices"] == 0
+
+    await asyncio.sleep(0.1)
+    assert [s["current_devices"] for s in read_hosts(hosts_file)] == [1, 4]
+
+
+@pytest.mark.asyncio
+async def test_external_edit_is_reloaded_with_pending_changes(hosts_file):
+    registry = ServerRegistry(str(hosts_file), flush_delay=10, reload_interval=0)
+    await registry.add_devices("a", +2)
+
+    # Оператор поднял лимит и добавил сервер
+    write_hosts(hosts_file, [
+        {"host": "a", "api_url": "https://a", "max_devices": 20, "current_devices": 3},
+        {"host": "c", "api_url": "https://c", "max_devices": 10, "current_devices": 0},
+    ])
+
+    servers = {s["host"]: s for s in await registry.get_servers()}
+    assert servers["a"]["max_devices"] == 20
+    assert servers["a"]["current_devices"] == 5
+    assert "c" in servers
+
+    await registry.flush()
+    assert read_hosts(hosts_file)[0]["current_devices"] == 5
+
+
+@pytest.mark.asyncio
+async def test_set_devices_overrides_counter(hosts_file):
+    registry = ServerRegistry(str(hosts_file), flush_delay=10)
+    await registry.add_devices("b", +3)
+    await registry.set_devices({"b": 2})
+    await registry.flush()
+
+    assert read_hosts(hosts_file)[1]["current_devices"] == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_saves_do_not_share_temp_file(hosts_file):
+    versions = [[{"host": str(i), "current_devices": i}] * 200 for i in range(10)]
+
+    await asyncio.gather(*(save_servers_to_file(str(hosts_file), servers) for servers in versions))
+
+    assert read_hosts(hosts_file) in versions
+    assert [p.name for p in hosts_file.parent.iterdir()] == ["hosts.json"]
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    async def issue_key(user_id):
+        calls.append(user_id)
+        await asyncio.sleep(0.01)
+        return f"key-{user_id}"
+
+    results = await asyncio.gather(*(flight.do(1, issue_key, 1) for _ in range(5)), flight.do(2, issue_key, 2))
+
+    assert results == ["key-1"] * 5 + ["key-2"]
+    assert calls == [1, 2]
+    assert len(flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_error_is_shared_and_next_call_runs_again():
+    flight = SingleFlight()
+    calls = []
+
+    async def issue_key():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("outline down")
+
+    results = await asyncio.gather(flight.do(1, issue_key), flight.do(1, issue_key), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    with pytest.raises(RuntimeError):
+        await flight.do(1, issue_key)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_call_is_not_joined():
+    flight = SingleFlight(ttl=0)
+    release = asyncio.Event()
+
+    async def hung():
+        await release.wait()
+        return "old"
+
+    async def fresh():
+        return "new"
+
+    first = asyncio.create_task(flight.do(1, hung))
+    await asyncio.sleep(0)
+    assert await flight.do(1, fresh) == "new"
+    release.set()
+    assert await first == "old"
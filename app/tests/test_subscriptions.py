@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+import subscriptions
+
+
+@pytest.fixture
+def pending(monkeypatch):
+    now = datetime.now()
+    rows = [
+        ("paid-1", 1, 100.0, 30, 11, now),
+        ("paid-2", 2, 100.0, 30, 12, now),
+        ("old", 3, 100.0, 30, 13, now - timedelta(hours=1)),
+        ("canceled", 4, 100.0, 30, 14, now),
+    ]
+    statuses = {"paid-1": "succeeded", "paid-2": "succeeded", "canceled": "canceled"}
+    calls = []
+
+    monkeypatch.setattr(subscriptions, "get_open_pending_payments", lambda: rows)
+    monkeypatch.setattr(subscriptions, "list_payments_since", AsyncMock(
+        return_value={payment_id: SimpleNamespace(status=status) for payment_id, status in statuses.items()}
+    ))
+    monkeypatch.setattr(subscriptions, "set_pending_status", lambda ids, status: calls.append(("status", list(ids), status)))
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_one_failed_activation_does_not_stop_reconcile(monkeypatch, pending):
+    async def activate(bot, user_id, payment_id, days, amount, message_id):
+        pending.append(("activate", payment_id))
+        if payment_id == "paid-1":
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+
+    monkeypatch.setattr(subscriptions, "activate_subscription", activate)
+    bot = SimpleNamespace(send_message=AsyncMock())
+
+    await subscriptions.reconcile_pending_payments(bot)
+
+    assert ("activate", "paid-2") in pending
+    assert ("status", ["paid-2"], "succeeded") in pending
+    assert ("status", ["canceled"], "canceled") in pending
+    assert ("status", ["old"], "expired") in pending
+    bot.send_message.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_expired_status_is_saved_before_notification(monkeypatch, pending):
+    monkeypatch.setattr(subscriptions, "activate_subscription", AsyncMock())
+
+    async def send_message(user_id, text):
+        pending.append(("send", user_id))
+        raise RuntimeError("Forbidden: bot was blocked by the user")
+
+    await subscriptions.reconcile_pending_payments(SimpleNamespace(send_message=send_message))
+
+    assert pending.index(("status", ["old"], "expired")) < pending.index(("send", 3))
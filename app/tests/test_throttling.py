@@ -0,0 +1,81 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import CallbackQuery
+
+from throttling import ThrottlingMiddleware, IN_PROGRESS_TEXT, TOO_FAST_TEXT
+
+
+def make_data(callback, user_id=1):
+    handler = HandlerObject(callback=callback, flags={"throttling": {"rate": 1 / 60}})
+    return {"handler": handler, "event_from_user": SimpleNamespace(id=user_id)}
+
+
+@pytest.mark.asyncio
+async def test_repeated_request_is_throttled():
+    middleware = ThrottlingMiddleware()
+    handler = AsyncMock()
+    event = SimpleNamespace(answer=AsyncMock())
+
+    async def process_trial_key(message):
+        pass
+
+    data = make_data(process_trial_key)
+    await middleware(handler, event, data)
+    await middleware(handler, event, data)
+    await middleware(handler, event, make_data(process_trial_key, user_id=2))
+
+    assert handler.await_count == 2
+    event.answer.assert_awaited_once_with(TOO_FAST_TEXT)
+
+
+@pytest.mark.asyncio
+async def test_request_in_flight_is_not_repeated():
+    middleware = ThrottlingMiddleware()
+    release = asyncio.Event()
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event)
+        await release.wait()
+
+    async def process_trial_key(message):
+        pass
+
+    event = SimpleNamespace(answer=AsyncMock())
+    data = make_data(process_trial_key)
+    data["handler"].flags["throttling"]["rate"] = 100
+    first = asyncio.create_task(middleware(handler, event, data))
+    await asyncio.sleep(0)
+    await middleware(handler, event, data)
+    release.set()
+    await first
+
+    assert len(calls) == 1
+    event.answer.assert_awaited_once_with(IN_PROGRESS_TEXT)
+
+
+@pytest.mark.asyncio
+async def test_suppressed_callback_query_is_still_answered():
+    middleware = ThrottlingMiddleware()
+    handler = AsyncMock()
+    event = CallbackQuery.model_construct(id="1", data="tariffs")
+    answers = []
+
+    async def answer(*args):
+        answers.append(args)
+
+    object.__setattr__(event, "answer", answer)
+
+    async def process_tariffs(callback):
+        pass
+
+    data = make_data(process_tariffs)
+    for _ in range(3):
+        await middleware(handler, event, data)
+
+    assert handler.await_count == 1
+    assert answers == [(TOO_FAST_TEXT,), ()]
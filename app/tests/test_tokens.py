@@ -0,0 +1,29 @@
+import base64
+import os
+
+import pytest
+
+os.environ.setdefault("SECRET_KEY", base64.b64encode(b"0123456789abcdef").decode())
+
+from tokens import sign_token, parse_token, encrypt_telegram_id, TOKEN_PREFIX
+
+
+def test_signed_token_round_trip():
+    token = sign_token(802171486, 1700000000)
+
+    assert token.startswith(TOKEN_PREFIX)
+    assert parse_token(token) == (802171486, 1700000000)
+
+
+def test_tampered_token_is_rejected():
+    token = sign_token(802171486, 1700000000)
+    forged = token[:-1] + ("A" if token[-1] != "A" else "B")
+
+    with pytest.raises(ValueError):
+        parse_token(forged)
+    with pytest.raises(ValueError):
+        parse_token(TOKEN_PREFIX + "garbage")
+
+
+def test_legacy_token_is_still_readable():
+    assert parse_token(encrypt_telegram_id(802171486)) == (802171486, None)
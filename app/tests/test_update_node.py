@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import pytest
+from pony.orm import db_session, select, delete
+
+import update_node
+from database import User, MigrationStep
+from update_node import NodeMigration
+
+SOURCE, TARGET = "10.0.0.1", "10.0.0.2"
+USERS = (9001, 9002, 9003)
+
+
+class FakeOutline:
+    def __init__(self, keys=()):
+        self.keys = list(keys)
+        self.created, self.deleted = [], []
+
+    async def list_access_keys(self):
+        return self.keys
+
+    async def create_access_key(self, name):
+        self.created.append(name)
+        return {"id": str(100 + len(self.created)), "port": 443, "password": "p", "method": "m", "accessUrl": "ss://new"}
+
+    async def delete_access_key(self, key_id):
+        self.deleted.append(key_id)
+        return 204
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.devices = {SOURCE: 0, TARGET: 0}
+
+    async def get_server(self, host):
+        return {"host": host, "api_url": host}
+
+    async def add_devices(self, host, delta):
+        self.devices[host] += delta
+
+    async def flush(self):
+        pass
+
+
+def cleanup():
+    with db_session:
+        delete(s for s in MigrationStep if s.telegram_id in USERS)
+        delete(u for u in User if u.telegram_id in USERS)
+
+
+@pytest.fixture
+def outline(monkeypatch):
+    cleanup()
+    with db_session:
+        User(telegram_id=9001, host=SOURCE, key_id=1)
+        User(telegram_id=9002, host=SOURCE, key_id=2)
+        # Прошлый запуск успел перенести пользователя, но не удалил старый ключ
+        User(telegram_id=9003, host=TARGET, key_id=50)
+        MigrationStep(source=SOURCE, target=TARGET, telegram_id=9003, old_key_id=3, new_key_id=50, status="moved")
+
+    clients = {
+        SOURCE: FakeOutline(),
+        # Ключ для 9001 создан прерванным запуском
+        TARGET: FakeOutline([{"id": "77", "name": "9001", "port": 443, "password": "p", "method": "m", "accessUrl": "ss://old"}]),
+    }
+    registry = FakeRegistry()
+    monkeypatch.setattr(update_node, "get_client", lambda api_url: clients[api_url])
+    monkeypatch.setattr(update_node, "registry", registry)
+    yield SimpleNamespace(clients=clients, registry=registry)
+    cleanup()
+
+
+@pytest.mark.asyncio
+async def test_resumed_migration_reuses_keys_and_finishes_deletes(outline):
+    migration = NodeMigration(SOURCE, TARGET, concurrency=2, batch_size=1)
+    await migration.run()
+
+    assert outline.clients[TARGET].created == ["9002"]
+    assert sorted(outline.clients[SOURCE].deleted) == [1, 2, 3]
+    with db_session:
+        assert {u.telegram_id: (u.host, u.key_id) for u in select(u for u in User if u.telegram_id in USERS)} == {
+            9001: (TARGET, 77), 9002: (TARGET, 101), 9003: (TARGET, 50),
+        }
+        assert {s.telegram_id: s.status for s in select(s for s in MigrationStep if s.telegram_id in USERS)} == {
+            9001: "done", 9002: "done", 9003: "done",
+        }
+    assert outline.registry.devices == {SOURCE: -2, TARGET: 2}
+    assert migration.moved == 2
+
+
+@pytest.mark.asyncio
+async def test_key_replaced_during_migration_is_discarded(outline, monkeypatch):
+    apply = NodeMigration._apply
+
+    def apply_after_revocation(self, moved, failed, deleted):
+        with db_session:
+            User[9002].key_id = None  # Ключ отозвали, пока создавался новый
+        return apply(self, moved, failed, deleted)
+
+    monkeypatch.setattr(NodeMigration, "_apply", apply_after_revocation)
+    await NodeMigration(SOURCE, TARGET, batch_size=10).run()
+
+    assert "101" in outline.clients[TARGET].deleted
+    with db_session:
+        assert User[9002].host == SOURCE
+        assert MigrationStep.get(source=SOURCE, target=TARGET, telegram_id=9002) is None
@@ -0,0 +1,69 @@
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery
+from cache import TTLCache
+from ratelimit import KeyedBuckets
+
+IN_PROGRESS_TEXT = "⏳ Запрос уже обрабатывается, подождите немного."
+TOO_FAST_TEXT = "⏳ Слишком часто. Попробуйте через несколько секунд."
+WARN_INTERVAL = 5  # Не чаще одного предупреждения на пользователя и хендлер за столько секунд
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту дорогих хендлеров для каждого пользователя.
+
+    Включается флагом хендлера, например
+    @router.message(F.text == "Пробный ключ", flags={"throttling": {"rate": 1 / 10}})
+    rate - запросов в секунду, burst - сколько можно подряд, key - общее
+    ведро для нескольких хендлеров. Пока предыдущий запрос пользователя к
+    хендлеру не завершён, повторный не выполняется. Подключается как
+    inner-middleware, чтобы флаги выбранного хендлера были известны.
+
+    Ведра и незавершённые запросы хранятся в памяти процесса. В режиме
+    вебхука с BOT_WORKERS > 1 у каждого воркера свой счёт: пользователь,
+    чьи апдейты nginx раскладывает по разным воркерам, получает до
+    BOT_WORKERS-кратного лимита, а повторный запрос в другом воркере
+    выполняется, даже если первый ещё не завершён. Защита от двойного
+    выполнения, которая должна работать между процессами, - на стороне
+    самих операций (например, advisory-блокировки при выдаче ключа).
+    """
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._buckets = {}  # ключ хендлера -> ведра пользователей
+        self._in_flight = set()  # (пользователь, ключ хендлера)
+        self._warned = TTLCache(maxsize=max_users, ttl=WARN_INTERVAL)
+
+    async def __call__(self, handler, event, data):
+        throttling = get_flag(data, "throttling")
+        user = data.get("event_from_user")
+        if not throttling or user is None:
+            return await handler(event, data)
+
+        name = throttling.get("key") or data["handler"].callback.__name__
+        key = (user.id, name)
+        if key in self._in_flight:
+            return await self._warn(event, key, IN_PROGRESS_TEXT)
+
+        buckets = self._buckets.get(name)
+        if buckets is None:
+            buckets = self._buckets[name] = KeyedBuckets(
+                throttling.get("rate", 1), throttling.get("burst", 1), self.max_users
+            )
+        if not buckets.get(user.id).try_acquire():
+            return await self._warn(event, key, TOO_FAST_TEXT)
+
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+
+    async def _warn(self, event, key, text):
+        # У callback_query ответ - всплывающая подсказка, у сообщения - короткий ответ
+        if self._warned.get(key) is None:
+            self._warned.set(key, True)
+            await event.answer(text)
+        elif isinstance(event, CallbackQuery):
+            # На callback_query отвечаем всегда, иначе у клиента крутится индикатор загрузки
+            await event.answer()
@@ -0,0 +1,83 @@
+from Crypto.Cipher import AES
+import base64
+import hashlib
+import hmac
+import os
+import struct
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Декодируем SECRET_KEY из .env
+SECRET_KEY = base64.b64decode(os.getenv("SECRET_KEY"))
+if len(SECRET_KEY) not in [16, 24, 32]:
+    raise ValueError("Неверная длина SECRET_KEY! Должно быть 16, 24 или 32 байта.")
+
+# Формат v2: "v2." + base64url(telegram_id, эпоха, подпись). Подделанный или
+# испорченный токен отбрасывается без обращения к БД.
+TOKEN_PREFIX = "v2."
+_PAYLOAD = struct.Struct(">QI")  # telegram_id, эпоха
+_TAG_SIZE = 12
+
+# Ключ подписи выводим из SECRET_KEY, чтобы не использовать один ключ для AES и HMAC.
+# Состояние HMAC с ключом готовим один раз и только копируем на каждый токен.
+_MAC = hmac.new(hmac.new(SECRET_KEY, b"conf-token-v2", hashlib.sha256).digest(), digestmod=hashlib.sha256)
+
+# В режиме ECB объект шифра не хранит состояния, его можно переиспользовать
+_LEGACY_CIPHER = AES.new(SECRET_KEY, AES.MODE_ECB)
+
+_EPOCH_START = datetime(1970, 1, 1)
+
+
+def account_epoch(created_at: datetime) -> int:
+    """Эпоха учетной записи: меняется, если пользователя удалили и создали заново."""
+    return int((created_at - _EPOCH_START).total_seconds())
+
+
+def _sign(payload: bytes) -> bytes:
+    mac = _MAC.copy()
+    mac.update(payload)
+    return mac.digest()[:_TAG_SIZE]
+
+
+def sign_token(telegram_id: int, epoch: int) -> str:
+    """Создает подписанный токен для динамического ключа."""
+    payload = _PAYLOAD.pack(telegram_id, epoch)
+    return TOKEN_PREFIX + base64.urlsafe_b64encode(payload + _sign(payload)).decode().rstrip("=")
+
+
+def parse_token(token: str):
+    """Возвращает (telegram_id, эпоха). Для старых токенов эпоха None."""
+    if not token.startswith(TOKEN_PREFIX):
+        return decrypt_telegram_id(token), None
+
+    try:
+        raw = base64.urlsafe_b64decode(token[len(TOKEN_PREFIX):] + "==")
+    except Exception as e:
+        raise ValueError(f"Ошибка декодирования токена: {e}")
+    if len(raw) != _PAYLOAD.size + _TAG_SIZE:
+        raise ValueError("Неверная длина токена")
+
+    payload, tag = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(tag, _sign(payload)):
+        raise ValueError("Неверная подпись токена")
+    return _PAYLOAD.unpack(payload)
+
+
+def pad(text: str) -> bytes:
+    """Дополняем текст до кратного 16 размера (AES требует фиксированную длину блока)."""
+    return text.encode() + b" " * (16 - len(text) % 16)
+
+def encrypt_telegram_id(telegram_id: int) -> str:
+    """Шифрует telegram_id и возвращает Base64 строку (старый формат)."""
+    encrypted = _LEGACY_CIPHER.encrypt(pad(str(telegram_id)))
+    return base64.urlsafe_b64encode(encrypted).decode()
+
+def decrypt_telegram_id(encrypted_id: str) -> int:
+    """Дешифрует Base64 строку обратно в telegram_id (старый формат)."""
+    try:
+        decrypted = _LEGACY_CIPHER.decrypt(base64.urlsafe_b64decode(encrypted_id)).strip()
+        return int(decrypted.decode())
+    except Exception as e:
+        raise ValueError(f"Ошибка расшифровки ID: {e}")
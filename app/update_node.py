@@ -1,110 +1,243 @@
+"""Перенос пользователей со старого сервера Outline на новый.
+
+    python update_node.py --source 1.2.3.4 --target 5.6.7.8 [--concurrency 10] [--batch-size 100] [--dry-run]
+
+Серверы берутся из hosts.json. Для каждого пользователя сначала создаётся ключ
+на новом сервере, затем пачкой сохраняются данные в БД и только после этого
+удаляется старый ключ, поэтому пользователь не остаётся без доступа.
+Ход переноса пишется в таблицу MigrationStep: повторный запуск с теми же
+серверами продолжает с места остановки, а ключи, созданные на новом сервере
+до сбоя, переиспользуются (по имени ключа = telegram_id).
+"""
+import argparse
 import asyncio
-import aiohttp
+import time
+from datetime import datetime
 from logger import logger
-from pony.orm import db_session, commit
-from database import User
+from pony.orm import db_session, select
+from database import User, MigrationStep, notify_users_changed
+from outline import get_client, close_clients
+from servers import registry
 
-# Настройки серверов
-OLD_SERVER = ''
-OLD_API = ''
-
-NEW_SERVER = ''
-NEW_API = ''
-
-# Ограничение количества одновременных запросов
-SEMAPHORE_LIMIT = 10  # Количество одновременных запросов к API
-semaphore = asyncio.Semaphore(SEMAPHORE_LIMIT)
+CONCURRENCY = 10  # Одновременных запросов к серверам Outline
+BATCH_SIZE = 100  # Пользователей в одной транзакции
 
 
 @db_session
-def get_users_to_update():
-    """Генератор пользователей, подключенных к старому серверу (по одному за раз)."""
-    for user in User.select().filter(lambda u: u.host == OLD_SERVER):
-        yield user
+def get_users_to_move(source):
+    """Пользователи с ключом на старом сервере: (telegram_id, key_id)."""
+    return select(
+        (u.telegram_id, u.key_id) for u in User
+        if u.host == source and u.key_id is not None
+    ).order_by(1)[:]
 
 
-async def delete_old_vpn_key(user):
-    """Удаляет старый VPN-ключ пользователя на старом сервере."""
-    headers = {"Content-Type": "application/json"}
-    async with semaphore, aiohttp.ClientSession() as session:
+@db_session
+def get_undeleted_keys(source, target):
+    """Перенесённые пользователи, чей старый ключ ещё не удалён: (telegram_id, old_key_id)."""
+    return select(
+        (s.telegram_id, s.old_key_id) for s in MigrationStep
+        if s.source == source and s.target == target and s.status == "moved"
+    )[:]
+
+
+def _save_step(source, target, telegram_id, **fields):
+    step = MigrationStep.get(source=source, target=target, telegram_id=telegram_id)
+    if step is None:
+        MigrationStep(source=source, target=target, telegram_id=telegram_id, **fields)
+    else:
+        step.set(updated_at=datetime.now(), **fields)
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} мин {seconds} с" if minutes else f"{seconds} с"
+
+
+class NodeMigration:
+    """Конвейер переноса: ограниченный пул воркеров и пакетная запись в БД."""
+
+    def __init__(self, source, target, concurrency=CONCURRENCY, batch_size=BATCH_SIZE, dry_run=False):
+        self.source = source
+        self.target = target
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self._queue = asyncio.Queue()
+        self._moved = []  # (telegram_id, old_key_id, данные нового ключа) до записи в БД
+        self._failed = []  # (telegram_id, old_key_id, ошибка)
+        self._deleted = []  # telegram_id, чей старый ключ удалён
+        self._reusable = {}  # telegram_id -> ключ, уже созданный на новом сервере
+        self.total = 0
+        self.moved = 0
+        self.failed = 0
+        self._started = None
+
+    async def run(self):
+        source_server = await registry.get_server(self.source)
+        target_server = await registry.get_server(self.target)
+        if not source_server or not target_server:
+            raise SystemExit(f"Сервер {self.source if not source_server else self.target} не найден в hosts.json")
+        self.source_client = get_client(source_server["api_url"])
+        self.target_client = get_client(target_server["api_url"])
+
+        users = await asyncio.to_thread(get_users_to_move, self.source)
+        undeleted = await asyncio.to_thread(get_undeleted_keys, self.source, self.target)
+        self.total = len(users)
+        logger.info(
+            f"🚚 Перенос {self.source} → {self.target}: {self.total} пользователей, "
+            f"{len(undeleted)} старых ключей ждут удаления"
+        )
+        if self.dry_run:
+            logger.info("Пробный запуск: изменения не вносятся.")
+            return
+
+        # Ключи, созданные прошлым прерванным запуском, не создаём повторно
+        for key in await self.target_client.list_access_keys():
+            if key.get("name", "").isdigit():
+                self._reusable[int(key["name"])] = key
+
+        for telegram_id, old_key_id in undeleted:
+            self._queue.put_nowait(("delete", telegram_id, old_key_id))
+        for telegram_id, old_key_id in users:
+            self._queue.put_nowait(("move", telegram_id, old_key_id))
+
+        self._started = time.monotonic()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
         try:
-            async with session.delete(f"{OLD_API}{user.key_id}", headers=headers, ssl=False) as response:
-                if response.status == 204:
-                    logger.info(f"✅ Ключ для пользователя {user.telegram_id} удален.")
+            # Запись последней пачки добавляет в очередь удаление старых ключей
+            await self._queue.join()
+            while await self._flush():
+                await self._queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self._flush()
+            await registry.flush()
+
+        logger.info(
+            f"✅ Перенос завершен за {_format_duration(time.monotonic() - self._started)}: "
+            f"перенесено {self.moved}, ошибок {self.failed}"
+        )
+
+    async def _worker(self):
+        while True:
+            action, telegram_id, key_id = await self._queue.get()
+            try:
+                if action == "move":
+                    await self._move(telegram_id, key_id)
                 else:
-                    logger.error(f"❌ Не удалось удалить ключ {user.key_id} (пользователь {user.telegram_id}). Статус: {response.status}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка удаления ключа для пользователя {user.telegram_id}: {e}")
-
-
-async def request_access_key(user_id: int) -> dict:
-    """Отправляет POST-запрос на новый сервер Outline и возвращает данные подключения."""
-    headers = {"Content-Type": "application/json"}
-    payload = {"name": str(user_id)}  # Telegram ID в качестве имени ключа
-
-    async with semaphore, aiohttp.ClientSession() as session:
+                    await self._delete(telegram_id, key_id)
+                if len(self._moved) + len(self._failed) + len(self._deleted) >= self.batch_size:
+                    await self._flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки пользователя {telegram_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _move(self, telegram_id, old_key_id):
+        key = self._reusable.pop(telegram_id, None)
+        if key is None:
+            try:
+                key = await self.target_client.create_access_key(str(telegram_id))
+            except Exception as e:
+                self._failed.append((telegram_id, old_key_id, repr(e)))
+                return
+        self._moved.append((telegram_id, old_key_id, key))
+
+    async def _delete(self, telegram_id, old_key_id):
+        status = await self.source_client.delete_access_key(old_key_id)
+        if status in (204, 404):
+            self._deleted.append(telegram_id)
+
+    async def _discard(self, key_id):
+        """Удаляет с нового сервера ключ, который не пригодился."""
         try:
-            async with session.post(NEW_API, headers=headers, json=payload, ssl=False) as response:
-                response.raise_for_status()  # Проверяем HTTP-статус ответа
-
-                data = await response.json()  # Декодируем JSON-ответ
-                if not data or "accessUrl" not in data:
-                    logger.error(f"❌ Некорректный ответ сервера Outline для пользователя {user_id}")
-                    return None
-
-                return {
-                    "access_key": data["accessUrl"],
-                    "key_id": data["id"],
-                    "server_port": data["port"],
-                    "method": data["method"],
-                    "password": data["password"]
-                }
-
-        except aiohttp.ClientResponseError as e:
-            logger.error(f"❌ Ошибка HTTP {e.status}: {e.message} для пользователя {user_id}")
-        except aiohttp.ClientError as e:
-            logger.error(f"❌ Ошибка при запросе к серверу Outline: {e}")
+            await self.target_client.delete_access_key(key_id)
         except Exception as e:
-            logger.error(f"❌ Неизвестная ошибка при генерации ключа: {e}")
-
-    return None  # Если что-то пошло не так, возвращаем None
-
-
-@db_session
-def update_user_data(user, ss_data: dict):
-    """Обновляет данные пользователя в БД с новым VPN-ключом."""
+            logger.error(f"❌ Не удалось удалить лишний ключ {key_id} на {self.target}: {e}")
+
+    async def _flush(self) -> int:
+        """Пишет накопленные результаты одной транзакцией; возвращает число новых удалений в очереди."""
+        moved, self._moved = self._moved, []
+        failed, self._failed = self._failed, []
+        deleted, self._deleted = self._deleted, []
+        if not (moved or failed or deleted):
+            return 0
+
+        # Транзакция в отдельном потоке: запросы воркеров к Outline в это время продолжаются
+        applied, unused = await asyncio.to_thread(self._apply, moved, failed, deleted)
+        for telegram_id, old_key_id in applied:
+            self._queue.put_nowait(("delete", telegram_id, old_key_id))
+        for key_id in unused:
+            await self._discard(key_id)
+
+        if applied:
+            await registry.add_devices(self.source, -len(applied))
+            await registry.add_devices(self.target, len(applied))
+
+        self.moved += len(applied)
+        self.failed += len(failed)
+        if not (applied or failed):
+            return 0
+        done = self.moved + self.failed
+        elapsed = time.monotonic() - self._started
+        rate = done / elapsed if elapsed else 0
+        eta = _format_duration((self.total - done) / rate) if rate else "?"
+        logger.info(f"📦 {done}/{self.total} ({rate:.1f} польз./с, осталось ~{eta})")
+        return len(applied)
+
+    @db_session
+    def _apply(self, moved, failed, deleted):
+        applied, unused = [], []
+        for telegram_id, old_key_id, key in moved:
+            user = User.get(telegram_id=telegram_id)
+            # Ключ мог быть отозван или заменён, пока создавался новый
+            if not user or user.host != self.source or user.key_id != old_key_id:
+                unused.append(key["id"])
+                continue
+            user.set(
+                host=self.target,
+                server_port=str(key["port"]),
+                password=key["password"],
+                method=key["method"],
+                key_id=int(key["id"]),
+                access_key=key["accessUrl"],
+            )
+            _save_step(self.source, self.target, telegram_id,
+                       old_key_id=old_key_id, new_key_id=int(key["id"]), status="moved", error=None)
+            applied.append((telegram_id, old_key_id))
+
+        for telegram_id, old_key_id, error in failed:
+            _save_step(self.source, self.target, telegram_id, old_key_id=old_key_id, status="failed", error=error)
+            logger.error(f"❌ Не удалось создать ключ для {telegram_id}: {error}")
+
+        for telegram_id in deleted:
+            _save_step(self.source, self.target, telegram_id, status="done")
+
+        notify_users_changed([telegram_id for telegram_id, _ in applied])
+        return applied, unused
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Перенос пользователей между серверами Outline")
+    parser.add_argument("--source", required=True, help="host старого сервера из hosts.json")
+    parser.add_argument("--target", required=True, help="host нового сервера из hosts.json")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="одновременных запросов к Outline")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="пользователей в одной транзакции")
+    parser.add_argument("--dry-run", action="store_true", help="только показать, сколько пользователей будет перенесено")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    migration = NodeMigration(args.source, args.target, args.concurrency, args.batch_size, args.dry_run)
     try:
-        user.host = NEW_SERVER
-        user.server_port = ss_data["server_port"]
-        user.password = ss_data["password"]
-        user.method = ss_data["method"]
-        user.key_id = ss_data["key_id"]
-        user.access_key = ss_data["access_key"]
-        commit()
-        logger.info(f"✅ Данные пользователя {user.telegram_id} обновлены на новый сервер.")
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления пользователя {user.telegram_id}: {e}")
-
-
-async def migrate_users_to_new_server():
-    """Основная функция для удаления старых ключей и генерации новых."""
-    users = get_users_to_update()  # Используем генератор напрямую
-    processed_users = 0  # Счетчик обработанных пользователей
-
-    async for user in users:
-        # Удаляем старый ключ
-        await delete_old_vpn_key(user)
-
-        # Генерируем новый ключ
-        new_key_data = await request_access_key(user.telegram_id)
-        if new_key_data:
-            update_user_data(user, new_key_data)
-            processed_users += 1
-        else:
-            logger.error(f"❌ Не удалось сгенерировать новый ключ для {user.telegram_id}")
-
-    logger.info(f"✅ Перенос завершен. Обработано {processed_users} пользователей.")
+        await migration.run()
+    finally:
+        await close_clients()
 
 
 if __name__ == "__main__":
-    asyncio.run(migrate_users_to_new_server())
\ No newline at end of file
+    asyncio.run(main())
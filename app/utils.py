@@ -1,19 +1,13 @@
 from pony.orm import db_session, commit
-from database import User 
+from database import User, notify_users_changed
 from datetime import datetime
-from Crypto.Cipher import AES
-import base64
-import os
 from dotenv import load_dotenv
 from logger import logger
+from profiles import invalidate_profile
+from tokens import encrypt_telegram_id, decrypt_telegram_id  # noqa: F401 - старый формат ключей
 
 load_dotenv()
 
-# Декодируем SECRET_KEY из .env
-SECRET_KEY = base64.b64decode(os.getenv("SECRET_KEY"))
-if len(SECRET_KEY) not in [16, 24, 32]:
-    raise ValueError("Неверная длина SECRET_KEY! Должно быть 16, 24 или 32 байта.")
-
 @db_session
 def check_active_subscription(telegram_id: int) -> bool:
     """Проверка наличия активной подписки"""
@@ -22,25 +16,6 @@ def check_active_subscription(telegram_id: int) -> bool:
         return True
     return False
 
-def pad(text: str) -> bytes:
-    """Дополняем текст до кратного 16 размера (AES требует фиксированную длину блока)."""
-    return text.encode() + b" " * (16 - len(text) % 16)
-
-def encrypt_telegram_id(telegram_id: int) -> str:
-    """Шифрует telegram_id и возвращает Base64 строку."""
-    cipher = AES.new(SECRET_KEY, AES.MODE_ECB)
-    encrypted = cipher.encrypt(pad(str(telegram_id)))
-    return base64.urlsafe_b64encode(encrypted).decode()
-
-def decrypt_telegram_id(encrypted_id: str) -> int:
-    """Дешифрует Base64 строку обратно в telegram_id."""
-    try:
-        cipher = AES.new(SECRET_KEY, AES.MODE_ECB)
-        decrypted = cipher.decrypt(base64.urlsafe_b64decode(encrypted_id)).strip()
-        return int(decrypted.decode())
-    except Exception as e:
-        raise ValueError(f"Ошибка расшифровки ID: {e}")
-    
 async def update_user_data(user_id, ss_data, dynamic_key):
     """Обновляет данные пользователя в базе данных."""
     with db_session:
@@ -53,6 +28,8 @@ async def update_user_data(user_id, ss_data, dynamic_key):
             user.key_id = ss_data["key_id"]
             user.access_key = ss_data["access_key"]
             user.dynamic_key = dynamic_key
+            notify_users_changed([user_id])
             commit()
+            invalidate_profile(user_id)
         else:
             logger.error(f"Не найден пользователь {user_id} для обновления данных!")
\ No newline at end of file